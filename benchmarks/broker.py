@@ -0,0 +1,186 @@
+import itertools
+import threading
+from collections import deque
+
+from pika.adapters.select_connection import IOLoop
+from pika.spec import Basic, BasicProperties
+
+from core import codec
+
+
+class Broker(object):
+    """
+    In-process stand-in for RabbitMQ: direct routing from routing keys to
+    queues, at most prefetch_count unacked deliveries per channel and
+    multiple acks. Channel calls run on the connection's ioloop, like pika;
+    publish() may be called from any thread.
+    """
+
+    def __init__(self):
+        self.queues = {}
+        self.bindings = {}
+        self.published = 0
+        self.acked = 0
+        self.ack_frames = 0
+        self.on_drained = None
+        self._channels = []
+        self._lock = threading.Lock()
+
+    def queue(self, name):
+        return self.queues.setdefault(name, deque())
+
+    def put(self, queue_name, body):
+        self.queue(queue_name).append(body)
+
+    def publish(self, routing_key, body):
+        with self._lock:
+            self.published += 1
+        queue_name = self.bindings.get(routing_key)
+        if queue_name is not None:
+            self.put(queue_name, body)
+            for channel in self._channels:
+                channel.connection.ioloop.add_callback_threadsafe(
+                    channel.deliver)
+
+    def connect(self, on_open_callback, on_close_callback):
+        return Connection(self, on_open_callback, on_close_callback)
+
+    def check_drained(self):
+        if self.on_drained is None:
+            return
+        for channel in self._channels:
+            if channel.unacked or (
+                    channel.consumer and self.queues.get(channel.consumer)):
+                return
+        self.on_drained()
+
+
+class Connection(object):
+    def __init__(self, broker, on_open_callback, on_close_callback):
+        self.broker = broker
+        self.ioloop = IOLoop()
+        self.is_closed = False
+        self.is_closing = False
+        self._on_close_callback = on_close_callback
+        self.ioloop.add_callback_threadsafe(
+            lambda: on_open_callback(self))
+
+    def channel(self, on_open_callback):
+        channel = Channel(self)
+        self.broker._channels.append(channel)
+        self.ioloop.add_callback_threadsafe(lambda: on_open_callback(channel))
+        return channel
+
+    def close(self):
+        self.is_closed = True
+        self.ioloop.add_callback_threadsafe(
+            lambda: self._on_close_callback(self, 'closed by client'))
+
+
+class Channel(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.broker = connection.broker
+        self.is_open = True
+        self.consumer = None
+        self.unacked = set()
+        self._prefetch_count = 0
+        self._callback = None
+        self._close_callbacks = []
+        self._tags = itertools.count(1)
+
+    def __int__(self):
+        return 1
+
+    def _reply(self, callback):
+        if callback is not None:
+            self.connection.ioloop.add_callback_threadsafe(
+                lambda: callback(None))
+
+    def add_on_close_callback(self, callback):
+        self._close_callbacks.append(callback)
+
+    def add_on_cancel_callback(self, callback):
+        pass
+
+    def exchange_declare(self, exchange, exchange_type, durable, callback):
+        self._reply(callback)
+
+    def queue_declare(self, queue, durable, callback):
+        self.broker.queue(queue)
+        self._reply(callback)
+
+    def queue_bind(self, queue, exchange, routing_key, callback):
+        self.broker.bindings[routing_key] = queue
+        self._reply(callback)
+
+    def basic_qos(self, prefetch_count, callback):
+        self._prefetch_count = prefetch_count
+        self._reply(callback)
+
+    def basic_consume(self, queue, on_message_callback):
+        self.consumer = queue
+        self._callback = on_message_callback
+        self.connection.ioloop.add_callback_threadsafe(self.deliver)
+        return 'ctag1'
+
+    def basic_cancel(self, consumer_tag, callback):
+        self.consumer = None
+        self._reply(callback)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.broker.publish(routing_key, body)
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.broker.ack_frames += 1
+        if multiple:
+            tags = [tag for tag in self.unacked if tag <= delivery_tag]
+        else:
+            tags = [delivery_tag]
+        self.unacked.difference_update(tags)
+        self.broker.acked += len(tags)
+        self.deliver()
+        self.broker.check_drained()
+
+    def close(self):
+        self.is_open = False
+        for callback in self._close_callbacks:
+            self.connection.ioloop.add_callback_threadsafe(
+                lambda callback=callback: callback(self, 'closed by client'))
+
+    def deliver(self):
+        if self.consumer is None:
+            return
+        messages = self.broker.queue(self.consumer)
+        while messages and (not self._prefetch_count or
+                            len(self.unacked) < self._prefetch_count):
+            tag = next(self._tags)
+            self.unacked.add(tag)
+            self._callback(
+                self,
+                Basic.Deliver(delivery_tag=tag, routing_key=self.consumer),
+                BasicProperties(app_id='benchmark',
+                                content_type='application/json'),
+                messages.popleft())
+
+
+class BrokerPublisher(object):
+    """Takes the place of a PikaPublisher, publishes to the broker"""
+
+    def __init__(self, broker, routing_key):
+        self.broker = broker
+        self.routing_key = routing_key
+
+    def publish(self, message, routing_key=None):
+        body, _ = codec.encode(message)
+        self.broker.publish(routing_key or self.routing_key, body)
+        return True
+
+    def close(self):
+        pass
+
+
+def attach(consumer, broker):
+    """Makes `consumer` connect to the broker instead of RabbitMQ"""
+    consumer.connect = lambda: broker.connect(
+        consumer.on_connection_open, consumer.on_connection_closed)
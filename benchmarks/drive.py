@@ -0,0 +1,95 @@
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+VIDEO_MIME_TYPE = 'video/mp4'
+
+_parents = re.compile(r'"([^"]+)" in parents')
+
+
+class DriveTree(object):
+    """
+    Synthetic drive: every folder above `depth` holds `fanout` subfolders,
+    every folder holds `files` videos. Ids encode the path, so nothing is
+    kept in memory: "root", "root.0", "root.0.3", "root.0.3#1"...
+    """
+
+    def __init__(self, depth, fanout, files):
+        self.depth = depth
+        self.fanout = fanout
+        self.files = files
+
+    def children(self, folder_id):
+        items = []
+        if folder_id.count('.') < self.depth:
+            items.extend({'id': '{}.{}'.format(folder_id, index),
+                          'mimeType': FOLDER_MIME_TYPE}
+                         for index in range(self.fanout))
+        items.extend({'id': '{}#{}'.format(folder_id, index),
+                      'mimeType': VIDEO_MIME_TYPE}
+                     for index in range(self.files))
+        return items
+
+    @property
+    def folder_count(self):
+        return sum(self.fanout ** level for level in range(self.depth + 1))
+
+    @property
+    def file_count(self):
+        return self.folder_count * self.files
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class DriveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        query = parse_qs(urlparse(self.path).query)
+        items = []
+        for folder_id in _parents.findall(query.get('q', [''])[0]):
+            items.extend(server.tree.children(folder_id))
+        # orderBy "folder desc"
+        items.sort(key=lambda item: item['mimeType'] != FOLDER_MIME_TYPE)
+        offset = int(query.get('pageToken', ['0'])[0])
+        page_size = int(query.get('pageSize', ['1000'])[0])
+        content = {'files': items[offset:offset + page_size]}
+        if offset + page_size < len(items):
+            content['nextPageToken'] = str(offset + page_size)
+        with server.lock:
+            server.calls += 1
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_drive_server(tree, latency=0.0, port=0):
+    """
+    Serves files.list for `tree` on 127.0.0.1 in a daemon thread and
+    returns the server, its calls attribute counts the list requests
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), DriveHandler)
+    server.tree = tree
+    server.latency = latency
+    server.calls = 0
+    server.lock = threading.Lock()
+    server.url = 'http://127.0.0.1:{}/drive/v3/files'.format(
+        server.server_address[1])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,151 @@
+"""
+Offline throughput benchmarks, no RabbitMQ, MySQL or Google needed:
+
+    python -m benchmarks.run recheck cookie export --messages 5000
+
+Consumers run their real connection, dispatch and ack code against the
+in-process broker of benchmarks.broker and a sqlite database; the
+recheck rate limit is off so the handlers themselves are measured.
+extract_drive crawls a synthetic tree served by benchmarks.drive.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+BENCHMARKS = ('recheck', 'cookie', 'export')
+
+
+def setup_database(directory, credentials):
+    os.environ['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///{}'.format(
+        os.path.join(directory, 'benchmark.sqlite'))
+    from core.db import Base, get_engine_session
+    from models import Config, GDRIVE_API_KEY, GDRIVE_COOKIE_KEY
+    session = get_engine_session()
+    Base.metadata.create_all(session.get_bind())
+    for index in range(credentials):
+        session.add(Config(key=GDRIVE_API_KEY, value='key{}'.format(index),
+                           group='project{}'.format(index), expired_to=0,
+                           updated_timestamp=0))
+        session.add(Config(key=GDRIVE_COOKIE_KEY,
+                           value='cookie{}'.format(index),
+                           group='owner{}@benchmark'.format(index),
+                           expired_to=0, updated_timestamp=0))
+    session.commit()
+    session.remove()
+
+
+def run_consumer(consumer_class, bodies, args):
+    from benchmarks.broker import Broker, BrokerPublisher, attach
+    from workers.upload import UploadPublisher
+
+    broker = Broker()
+    consumer = consumer_class('amqp://benchmark',
+                              prefetch_count=args.prefetch,
+                              max_workers=args.workers)
+    consumer._upload_publisher = BrokerPublisher(
+        broker, UploadPublisher.ROUTING_KEY)
+    attach(consumer, broker)
+    for body in bodies:
+        broker.put(consumer.QUEUE, body)
+    broker.on_drained = consumer.stop_ioloop
+
+    started_at = time.perf_counter()
+    consumer.run()
+    elapsed = time.perf_counter() - started_at
+    consumer.stop()
+    return {
+        'messages': broker.acked,
+        'seconds': round(elapsed, 3),
+        'messages_per_second': round(broker.acked / elapsed, 1),
+        'ack_frames': broker.ack_frames,
+        'published': broker.published,
+    }
+
+
+def bench_recheck(args):
+    from workers.recheck import RecheckConsumer
+    # Emails nobody owns, limit_cookie runs its update without ever
+    # running out of cookies
+    bodies = [json.dumps({'email': 'user{}@benchmark'.format(index),
+                          'driveid': 'drive{}'.format(index)})
+              for index in range(args.messages)]
+    return run_consumer(RecheckConsumer, bodies, args)
+
+
+def bench_cookie(args):
+    from workers.cookie import CookieConsumer
+    bodies = [json.dumps({'email': 'user{}@benchmark'.format(index)})
+              for index in range(args.messages)]
+    return run_consumer(CookieConsumer, bodies, args)
+
+
+def bench_export(args):
+    from benchmarks.drive import DriveTree, start_drive_server
+    tree = DriveTree(args.depth, args.fanout, args.files)
+    server = start_drive_server(tree, latency=args.latency / 1000.0)
+    # Read when export_drive is imported
+    os.environ['DRIVE_API_URL'] = server.url
+    from workers.export_drive import DriveCrawler, DriveExtractorConsumer
+
+    consumer = DriveExtractorConsumer('amqp://benchmark')
+    crawler = DriveCrawler('benchmark', max_workers=args.workers)
+    started_at = time.perf_counter()
+    files = sum(len(urls) for urls in consumer.extract_drive('root', crawler))
+    elapsed = time.perf_counter() - started_at
+    server.shutdown()
+    if files != tree.file_count:
+        raise AssertionError('exported {} files of {}'.format(
+            files, tree.file_count))
+    return {
+        'folders': tree.folder_count,
+        'files': files,
+        'seconds': round(elapsed, 3),
+        'files_per_second': round(files / elapsed, 1),
+        'api_calls': server.calls,
+        'pages': crawler.pages,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.run')
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help='any of {}, all by default'.format(
+                            ', '.join(BENCHMARKS)))
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--prefetch', type=int, default=50)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--credentials', type=int, default=20)
+    parser.add_argument('--depth', type=int, default=3,
+                        help='levels of subfolders below the root')
+    parser.add_argument('--fanout', type=int, default=8,
+                        help='subfolders per folder')
+    parser.add_argument('--files', type=int, default=20,
+                        help='videos per folder')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='milliseconds added to every Drive API call')
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args(argv)
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark {}'.format(name))
+    args.benchmarks = args.benchmarks or list(BENCHMARKS)
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    from core.logs import setup_logging
+    setup_logging(level=args.log_level)
+    os.environ['RECHECK_RATE_LIMIT'] = '0'
+    with tempfile.TemporaryDirectory() as directory:
+        setup_database(directory, args.credentials)
+        for name in args.benchmarks:
+            result = globals()['bench_' + name](args)
+            print('{:<8} {}'.format(name, ' '.join(
+                '{}={}'.format(key, value) for key, value in result.items())))
+
+
+if __name__ == '__main__':
+    main()
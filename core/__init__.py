@@ -0,0 +1,9 @@
+import time
+
+# core is imported first by every worker, close enough to process start
+STARTED_AT = time.monotonic()
+
+
+def startup_time():
+    """Seconds elapsed since the worker process started importing core"""
+    return time.monotonic() - STARTED_AT
@@ -0,0 +1,47 @@
+import json
+import logging
+from os import environ as env, makedirs, path, remove, replace
+
+LOGGER = logging.getLogger(__name__)
+
+# Redelivered exports only resume on a worker that sees the checkpoint: the
+# image declares /data/checkpoints as a volume, mount one shared by every
+# export worker there. The default suits local runs
+CHECKPOINT_DIR = env.get('CHECKPOINT_DIR', './tmp/checkpoints')
+
+
+class FileCheckpointStore(object):
+    """
+    Keeps one JSON document per job in `directory`. Mount the directory on
+    a volume that outlives the worker process to resume after restarts.
+    """
+
+    def __init__(self, directory=CHECKPOINT_DIR):
+        self.directory = directory
+        makedirs(directory, exist_ok=True)
+
+    def _filepath(self, key):
+        return path.join(self.directory, '{}.json'.format(key))
+
+    def load(self, key):
+        filepath = self._filepath(key)
+        if not path.exists(filepath):
+            return None
+        try:
+            with open(filepath) as f:
+                return json.load(f)
+        except ValueError:
+            LOGGER.warning('Ignoring corrupted checkpoint %s', key)
+            return None
+
+    def save(self, key, state):
+        filepath = self._filepath(key)
+        # Write then rename so a crash never leaves a partial checkpoint
+        with open(filepath + '.tmp', 'w') as f:
+            json.dump(state, f)
+        replace(filepath + '.tmp', filepath)
+
+    def delete(self, key):
+        filepath = self._filepath(key)
+        if path.exists(filepath):
+            remove(filepath)
@@ -0,0 +1,105 @@
+import json
+import logging
+from os import environ as env
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+LOGGER = logging.getLogger(__name__)
+
+JSON_CONTENT_TYPE = 'application/json'
+MSGPACK_CONTENT_TYPE = 'application/msgpack'
+# Content type of the published messages, consumers decode any supported
+# type. Only switch it once every consumer of the queues can decode it
+AMQP_CONTENT_TYPE = env.get('AMQP_CONTENT_TYPE', JSON_CONTENT_TYPE)
+
+
+class InvalidMessageError(ValueError):
+    pass
+
+
+class JsonCodec(object):
+    """JSON through orjson when it is installed, the json module if not"""
+    content_type = JSON_CONTENT_TYPE
+
+    def encode(self, message):
+        if orjson is not None:
+            return orjson.dumps(message)
+        return json.dumps(message, ensure_ascii=False).encode('utf-8')
+
+    def decode(self, body):
+        try:
+            if orjson is not None:
+                return orjson.loads(body)
+            return json.loads(body)
+        except ValueError as exc:
+            raise InvalidMessageError('invalid json: {}'.format(exc))
+
+
+class MsgpackCodec(object):
+    content_type = MSGPACK_CONTENT_TYPE
+
+    def encode(self, message):
+        return msgpack.packb(message, use_bin_type=True)
+
+    def decode(self, body):
+        try:
+            return msgpack.unpackb(body, raw=False)
+        except Exception as exc:
+            raise InvalidMessageError('invalid msgpack: {}'.format(exc))
+
+
+codecs = {JSON_CONTENT_TYPE: JsonCodec()}
+if msgpack is not None:
+    codecs[MSGPACK_CONTENT_TYPE] = MsgpackCodec()
+if AMQP_CONTENT_TYPE not in codecs:
+    LOGGER.warning('No codec for %s, publishing %s', AMQP_CONTENT_TYPE,
+                   JSON_CONTENT_TYPE)
+    AMQP_CONTENT_TYPE = JSON_CONTENT_TYPE
+# Content types already warned about, once per process
+_unexpected_types = set()
+
+
+def get_codec(content_type):
+    # Publishers predating content types only sent json, others label it
+    # text/plain, application/octet-stream and the like: anything but
+    # msgpack is read as json, like every body was before
+    if not content_type:
+        return codecs[JSON_CONTENT_TYPE]
+    media_type = content_type.partition(';')[0].strip().lower()
+    codec = codecs.get(media_type)
+    if codec is not None:
+        return codec
+    if media_type == MSGPACK_CONTENT_TYPE:
+        raise InvalidMessageError('msgpack is not installed')
+    if media_type not in _unexpected_types:
+        _unexpected_types.add(media_type)
+        LOGGER.warning('Reading content type %s as %s', content_type,
+                       JSON_CONTENT_TYPE)
+    return codecs[JSON_CONTENT_TYPE]
+
+
+def encode(message, content_type=None):
+    """Returns (body, content_type) of a dict or Payload"""
+    codec = get_codec(content_type or AMQP_CONTENT_TYPE)
+    if hasattr(message, 'to_dict'):
+        message = message.to_dict()
+    return codec.encode(message), codec.content_type
+
+
+def decode(body, content_type=None, payload_class=None):
+    """
+    Decodes a body of `content_type`, into a validated payload_class
+    instance when one is given. Raises InvalidMessageError.
+    """
+    message = get_codec(content_type).decode(body)
+    if payload_class is not None:
+        return payload_class.from_dict(message)
+    return message
@@ -0,0 +1,95 @@
+import base64
+import hashlib
+import math
+
+
+def _digest(item):
+    return hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+
+
+class IdSet(object):
+    """
+    Set of string ids stored as 64 bit hashes, about 37% less memory than
+    a set of 33 character Drive ids. add() returns False for an id that
+    was already added, and for a new id only on a hash collision: one in
+    2^64 per pair of ids, so about n^2 / 2^65 false duplicates among n ids.
+    """
+
+    def __init__(self, items=None):
+        self._hashes = set(items or ())
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def add(self, item):
+        value = int.from_bytes(_digest(item)[:8], 'little')
+        if value in self._hashes:
+            return False
+        self._hashes.add(value)
+        return True
+
+    def state(self):
+        return {'type': 'hashed', 'hashes': list(self._hashes)}
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(state['hashes'])
+
+
+class BloomFilter(object):
+    """
+    Fixed size probabilistic set: add() returns False for an id that was
+    already added and, with probability `error_rate`, for a new one.
+    """
+
+    def __init__(self, capacity, error_rate=0.0001, bits=None, count=0):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(
+            -capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self._bits = bits if bits is not None \
+            else bytearray((self.size + 7) // 8)
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def _positions(self, item):
+        digest = _digest(item)
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item):
+        added = False
+        for position in self._positions(item):
+            byte, bit = divmod(position, 8)
+            if not self._bits[byte] & (1 << bit):
+                self._bits[byte] |= 1 << bit
+                added = True
+        if added:
+            self._count += 1
+        return added
+
+    def state(self):
+        return {
+            'type': 'bloom',
+            'capacity': self.capacity,
+            'error_rate': self.error_rate,
+            'count': self._count,
+            'bits': base64.b64encode(bytes(self._bits)).decode('ascii'),
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(state['capacity'], state['error_rate'],
+                   bytearray(base64.b64decode(state['bits'])),
+                   state['count'])
+
+
+def id_set_from_state(state):
+    if state['type'] == 'bloom':
+        return BloomFilter.from_state(state)
+    # 'hashed', checkpoints written before the rename say 'exact'
+    return IdSet.from_state(state)
@@ -0,0 +1,240 @@
+import atexit
+import json
+import logging
+import queue
+import re
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from os import environ as env
+
+from core import metrics
+
+LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
+              '-35s %(lineno) -5d: %(message)s')
+LOG_LEVEL = env.get('LOG_LEVEL', logging.INFO)
+# "text" (LOG_FORMAT), "kv" (key=value) or "json", one record per line
+LOG_OUTPUT = env.get('LOG_OUTPUT', 'text')
+# Records are written by a background thread, callers only enqueue them.
+# Records beyond LOG_QUEUE_SIZE waiting ones are dropped
+LOG_ASYNC = env.get('LOG_ASYNC', '1') == '1'
+LOG_QUEUE_SIZE = int(env.get('LOG_QUEUE_SIZE', 10000))
+# Every call site logs LOG_SAMPLE_BURST debug / info records per second,
+# then one in LOG_SAMPLE_EVERY; 0 disables sampling. Warnings and errors
+# are never sampled
+LOG_SAMPLE_BURST = int(env.get('LOG_SAMPLE_BURST', 100))
+LOG_SAMPLE_EVERY = int(env.get('LOG_SAMPLE_EVERY', 100))
+
+REDACTED_FIELDS = ('cookie', 'apikey', 'api_key')
+REDACTED = '***'
+
+_quoted_secret = re.compile(
+    r'''(["']?(?:{})["']?\s*[:=]\s*)(["'])(.*?)(?<!\\)\2'''.format(
+        '|'.join(REDACTED_FIELDS)), re.IGNORECASE)
+# An unquoted value, after "=" or a header's ": ", ends at whitespace, ","
+# or "&" (query strings), but takes in further "; name=value" pairs,
+# masking a whole cookie header
+_bare_secret = re.compile(
+    r'''(\b(?:{})(?:=|:[ \t]*))(?!["'])[^\s,&;)]+'''
+    r'''(?:;\s*[^\s,&;)=]+=[^\s,&;)]*)*'''
+    .format('|'.join(REDACTED_FIELDS)), re.IGNORECASE)
+_url_key = re.compile(r'([?&]key=)[^\s&]+')
+
+# Attributes of every LogRecord, the others were passed through `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord(
+    '', 0, '', 0, '', (), None))) | {'message', 'asctime', 'sampled'}
+
+LOG_RECORDS_DROPPED = metrics.registry.counter(
+    'log_records_dropped_total', 'Records dropped by a full log queue')
+
+_listener = None
+
+
+def redact(text):
+    """Masks cookie / api key values in `text`"""
+    text = _quoted_secret.sub(
+        lambda match: '{0}{1}{2}{1}'.format(
+            match.group(1), match.group(2), REDACTED), text)
+    text = _bare_secret.sub(r'\g<1>' + REDACTED, text)
+    return _url_key.sub(r'\g<1>' + REDACTED, text)
+
+
+def record_fields(record):
+    """Fields given through `extra`"""
+    return {key: value for key, value in vars(record).items()
+            if key not in _RECORD_ATTRIBUTES}
+
+
+class RedactingFilter(logging.Filter):
+    """
+    Renders the message and masks secrets in it and in the extra fields.
+    Sits on the output handler, so in async mode the regexes run on the
+    writer thread
+    """
+
+    def filter(self, record):
+        record.msg = redact(record.getMessage())
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+        if record.exc_text:
+            record.exc_text = redact(record.exc_text)
+        for key, value in record_fields(record).items():
+            if key.lower() in REDACTED_FIELDS:
+                setattr(record, key, REDACTED)
+            elif isinstance(value, str):
+                setattr(record, key, redact(value))
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Passes `burst` debug / info records per call site and second, then
+    one in `every`. Kept records carry how many they stand for in
+    `sampled`
+    """
+
+    def __init__(self, burst=LOG_SAMPLE_BURST, every=LOG_SAMPLE_EVERY):
+        super().__init__()
+        self.burst = burst
+        self.every = max(1, every)
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if not self.burst or record.levelno >= logging.WARNING:
+            return True
+        key = (record.pathname, record.lineno)
+        second = int(record.created)
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or window[0] != second:
+                window = self._windows[key] = [second, 0]
+            window[1] += 1
+            count = window[1]
+        if count <= self.burst:
+            return True
+        if (count - self.burst) % self.every:
+            return False
+        record.sampled = self.every
+        return True
+
+
+class TextFormatter(logging.Formatter):
+    """LOG_FORMAT followed by the extra fields as key=value"""
+
+    def format(self, record):
+        text = super().format(record)
+        fields = record_fields(record)
+        if getattr(record, 'sampled', None):
+            fields['sampled'] = record.sampled
+        if fields:
+            text += ' ' + ' '.join('{}={}'.format(key, _kv_value(value))
+                                   for key, value in fields.items())
+        return text
+
+
+def _kv_value(value):
+    value = str(value)
+    if not value or any(char in value for char in ' "='):
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+
+def _structured(formatter, record):
+    data = {
+        'time': formatter.formatTime(record),
+        'level': record.levelname,
+        'logger': record.name,
+        'msg': record.getMessage(),
+    }
+    data.update(record_fields(record))
+    if getattr(record, 'sampled', None):
+        data['sampled'] = record.sampled
+    if record.exc_text:
+        data['exc'] = record.exc_text
+    elif record.exc_info:
+        data['exc'] = formatter.formatException(record.exc_info)
+    return data
+
+
+class KeyValueFormatter(logging.Formatter):
+    def format(self, record):
+        return ' '.join('{}={}'.format(key, _kv_value(value))
+                        for key, value in _structured(self, record).items())
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        return json.dumps(_structured(self, record), ensure_ascii=False,
+                          default=str)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Enqueues records as they are, dropping them when the queue is
+    full instead of blocking the caller"""
+
+    def prepare(self, record):
+        # The message is rendered by the listener thread; tracebacks are
+        # formatted now, they hold on to every frame of the stack
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+
+def create_formatter(output=LOG_OUTPUT, fmt=LOG_FORMAT):
+    if output == 'json':
+        return JsonFormatter()
+    if output == 'kv':
+        return KeyValueFormatter()
+    return TextFormatter(fmt)
+
+
+def setup_logging(level=LOG_LEVEL, output=LOG_OUTPUT, fmt=LOG_FORMAT,
+                  asynchronous=LOG_ASYNC):
+    """
+    Configures the root logger of a worker process. Replaces handlers set
+    up before, e.g. the ones a supervised child inherited from its parent
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.setLevel(level)
+
+    output_handler = logging.StreamHandler()
+    output_handler.setFormatter(create_formatter(output, fmt))
+    if not asynchronous:
+        output_handler.addFilter(SamplingFilter())
+        output_handler.addFilter(RedactingFilter())
+        root.addHandler(output_handler)
+        return
+    output_handler.addFilter(RedactingFilter())
+
+    handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    handler.addFilter(SamplingFilter())
+    root.addHandler(handler)
+    _listener = QueueListener(handler.queue, output_handler)
+    _listener.start()
+
+
+def stop_logging():
+    """Writes the queued records out"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
@@ -1,30 +1,244 @@
+import logging
+import queue
 import smtplib
 import ssl
+import threading
+import time
+from contextlib import contextmanager
 from os import environ as env
 
+from core import metrics
+
+LOGGER = logging.getLogger(__name__)
+
 APP_NOREPLY_EMAIL_ADDRESS = 'noreply@localhost'
+SMTP_SERVER = env.get('MAILGUN_SMTP_SERVER', 'localhost')
+SMTP_PORT = int(env.get('MAILGUN_SMTP_PORT', 587))
+SMTP_USERNAME = env.get('MAILGUN_SMTP_USERNAME', 'admin')
+SMTP_PASSWORD = env.get('MAILGUN_SMTP_PASSWORD', 'admin')
+# "starttls", "ssl" (SMTPS) or "none", e.g. for a local SMTP stand-in.
+# An empty username skips the login
+SMTP_TLS = env.get('SMTP_TLS', 'starttls')
+SMTP_TIMEOUT = 30
+# Sessions kept open, each one sends up to SMTP_MAX_MESSAGES mails and is
+# renewed after SMTP_IDLE_TIMEOUT idle seconds, before servers drop it
+SMTP_POOL_SIZE = int(env.get('SMTP_POOL_SIZE', 2))
+SMTP_MAX_MESSAGES = int(env.get('SMTP_MAX_MESSAGES', 100))
+SMTP_IDLE_TIMEOUT = int(env.get('SMTP_IDLE_TIMEOUT', 60))
+# Mails waiting for a session and attempts per mail
+MAIL_QUEUE_SIZE = int(env.get('MAIL_QUEUE_SIZE', 1000))
+MAIL_RETRIES = int(env.get('MAIL_RETRIES', 3))
+
+MAILS_SENT = metrics.registry.counter('mail_sent_total', 'Mails sent')
+MAILS_FAILED = metrics.registry.counter(
+    'mail_failed_total', 'Mails given up after retries')
+
+
+def is_permanent(exc):
+    """5xx replies and refused recipients fail again on retry"""
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return True
+    return isinstance(exc, smtplib.SMTPResponseException) and \
+        exc.smtp_code >= 500
+
+
+class SMTPConnection(object):
+    """One SMTP session, connect, STARTTLS and LOGIN run once for many
+    mails"""
+
+    def __init__(self, sender):
+        self.sender = sender
+        self.server = None
+        self.sent = 0
+        self.used_at = 0
+
+    @property
+    def expired(self):
+        return self.sent >= SMTP_MAX_MESSAGES or \
+            time.monotonic() - self.used_at >= SMTP_IDLE_TIMEOUT
+
+    def open(self):
+        sender = self.sender
+        if sender.tls == 'ssl':
+            server = smtplib.SMTP_SSL(
+                sender.smtp_server, sender.port, timeout=SMTP_TIMEOUT,
+                context=sender.context)
+        else:
+            server = smtplib.SMTP(
+                sender.smtp_server, sender.port, timeout=SMTP_TIMEOUT)
+        try:
+            if sender.tls == 'starttls':
+                server.starttls(context=sender.context)
+            if sender.username:
+                server.login(sender.username, sender.password)
+        except Exception:
+            server.close()
+            raise
+        self.server = server
+        self.sent = 0
+        self.used_at = time.monotonic()
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        if self.server is None or self.expired:
+            self.close()
+            self.open()
+        self.server.sendmail(from_addr, to_addrs, msg)
+        self.sent += 1
+        self.used_at = time.monotonic()
+
+    def close(self):
+        if self.server is None:
+            return
+        server, self.server = self.server, None
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+
+
+class SMTPPool(object):
+    """Hands out up to `size` sessions, idle ones are reused"""
+
+    def __init__(self, sender, size=SMTP_POOL_SIZE):
+        self.sender = sender
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self):
+        with self._slots:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                connection = SMTPConnection(self.sender)
+            try:
+                yield connection
+            except Exception:
+                connection.close()
+                raise
+            self._idle.put(connection)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
 
 
 class MailSender(object):
-    def __init__(self):
-        self.port = 587
-        self.context = ssl.create_default_context()
-        self.smtp_server = env.get('MAILGUN_SMTP_SERVER', 'localhost')
-        self.username = env.get('MAILGUN_SMTP_USERNAME', 'admin')
-        self.password = env.get('MAILGUN_SMTP_PASSWORD', 'admin')
+    """
+    Sends mails over pooled SMTP sessions. send() delivers right away,
+    enqueue() hands the mail to background threads which retry transient
+    failures and report the outcome to an optional callback.
+    """
+
+    def __init__(self, smtp_server=SMTP_SERVER, port=SMTP_PORT,
+                 username=SMTP_USERNAME, password=SMTP_PASSWORD,
+                 tls=SMTP_TLS, pool_size=SMTP_POOL_SIZE):
+        self.port = port
+        self.tls = tls
+        self._context = None
+        self.smtp_server = smtp_server
+        self.username = username
+        self.password = password
         self.sender_email = APP_NOREPLY_EMAIL_ADDRESS
+        self.pool = SMTPPool(self, pool_size)
+        self._pool_size = pool_size
+        self._queue = queue.Queue(MAIL_QUEUE_SIZE)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    @property
+    def context(self):
+        # Loading the CA bundle is slow, only do it when a mail is sent
+        if self._context is None:
+            self._context = ssl.create_default_context()
+        return self._context
+
+    def _send(self, to_addrs, msg):
+        with self.pool.connection() as connection:
+            try:
+                connection.sendmail(self.sender_email, to_addrs, msg)
+            except smtplib.SMTPServerDisconnected:
+                # The server dropped the pooled session, once more on a
+                # fresh one
+                connection.close()
+                connection.sendmail(self.sender_email, to_addrs, msg)
+        MAILS_SENT.inc()
 
     def send(self, to_addrs, msg):
+        """Sends right away, returns whether the server accepted it"""
         try:
-            server = smtplib.SMTP(self.smtp_server, self.port)
-            server.starttls(context=self.context)  # Secure the connection
-            server.login(self.username, self.password)
-            # TODO: Send email here
-            server.sendmail(self.sender_email, to_addrs, msg)
-        except Exception as e:
-            self.app.logger.warning(e)
-        finally:
-            server.quit()
+            self._send(to_addrs, msg)
+            return True
+        except (smtplib.SMTPException, OSError) as exc:
+            LOGGER.warning('Sending mail to %s failed: %s', to_addrs, exc)
+            return False
+
+    def deliver(self, to_addrs, msg):
+        """Sends with up to MAIL_RETRIES attempts"""
+        for attempt in range(MAIL_RETRIES):
+            if attempt > 0:
+                time.sleep(2 ** attempt)
+            try:
+                self._send(to_addrs, msg)
+                return True
+            except (smtplib.SMTPException, OSError) as exc:
+                LOGGER.warning('Sending mail to %s failed: %s', to_addrs,
+                               exc)
+                if is_permanent(exc):
+                    break
+        LOGGER.error('Gave up sending mail to %s', to_addrs)
+        MAILS_FAILED.inc()
+        return False
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            self._threads = [
+                threading.Thread(target=self._run, name='mail', daemon=True)
+                for _ in range(self._pool_size)]
+            for thread in self._threads:
+                thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                to_addrs, msg, callback = item
+                sent = self.deliver(to_addrs, msg)
+                if callback is not None:
+                    callback(sent)
+            except Exception:
+                LOGGER.exception('Mail callback failed')
+            finally:
+                self._queue.task_done()
+
+    def enqueue(self, to_addrs, msg, callback=None):
+        """
+        Queues the mail and returns, callback(sent) runs on a mail thread
+        once it was sent or given up. Blocks while MAIL_QUEUE_SIZE mails
+        are waiting.
+        """
+        self._start()
+        self._queue.put((to_addrs, msg, callback))
+
+    def flush(self):
+        """Waits until every queued mail was sent or given up"""
+        self._queue.join()
+
+    def close(self):
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join()
+        self.pool.close()
 
 
 mailer = MailSender()
@@ -0,0 +1,69 @@
+from core.codec import InvalidMessageError
+
+
+class Payload(object):
+    """
+    Typed message body. Subclasses list their fields in __slots__ and the
+    accepted types in TYPES; fields in OPTIONAL may be missing or null.
+    from_dict rejects anything else with InvalidMessageError.
+    """
+    __slots__ = ()
+    TYPES = {}
+    OPTIONAL = ()
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join(
+            '{}={!r}'.format(name, getattr(self, name))
+            for name in self.__slots__))
+
+    @classmethod
+    def from_dict(cls, data):
+        if not isinstance(data, dict):
+            raise InvalidMessageError('{} must be an object'.format(
+                cls.__name__))
+        payload = cls.__new__(cls)
+        for name in cls.__slots__:
+            value = data.get(name)
+            if value is None:
+                if name not in cls.OPTIONAL:
+                    raise InvalidMessageError('{} is missing'.format(name))
+            elif not isinstance(value, cls.TYPES[name]) or \
+                    isinstance(value, bool):
+                raise InvalidMessageError('{} has an invalid type {}'.format(
+                    name, type(value).__name__))
+            setattr(payload, name, value)
+        return payload
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class CookiePayload(Payload):
+    __slots__ = ('email',)
+    TYPES = {'email': str}
+
+
+class RecheckPayload(Payload):
+    __slots__ = ('email', 'driveid')
+    TYPES = {'email': str, 'driveid': str}
+
+
+class UploadPayload(Payload):
+    __slots__ = ('cookie', 'apikey', 'driveid', 'email')
+    TYPES = {'cookie': str, 'apikey': str, 'driveid': str, 'email': str}
+
+
+class ExportPayload(Payload):
+    __slots__ = ('id', 'drive_id', 'api_key')
+    TYPES = {'id': (int, str), 'drive_id': str, 'api_key': str}
+    OPTIONAL = ('api_key',)
+
+
+class RegisterPayload(Payload):
+    __slots__ = ('email', 'active_code', 'expired', 'hash')
+    TYPES = {'email': str, 'active_code': (int, str), 'expired': (int, str),
+             'hash': str}
@@ -0,0 +1,221 @@
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from os import environ as env
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, 300)
+
+_handler = threading.local()
+
+
+def current_handler():
+    """Queue of the message handled by the calling thread, if any"""
+    return getattr(_handler, 'queue', '')
+
+
+def set_current_handler(queue):
+    _handler.queue = queue
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('"', '\\"'))
+        for name, value in zip(names, values)) + '}'
+
+
+class Metric(object):
+    TYPE = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield self.name, self.labelnames, key, value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.TYPE)]
+        for name, labelnames, key, value in self.samples():
+            lines.append('{}{} {}'.format(
+                name, _format_labels(labelnames, key), value))
+        return lines
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(
+                key, ([0] * (len(self.buckets) + 1), 0.0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            counts[-1] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(counts), total)
+                      for key, (counts, total) in self._values.items()}
+        labelnames = self.labelnames + ('le',)
+        for key, (counts, total) in sorted(values.items()):
+            bounds = [str(bound) for bound in self.buckets] + ['+Inf']
+            for bound, count in zip(bounds, counts):
+                yield self.name + '_bucket', labelnames, key + (bound,), count
+            yield self.name + '_count', self.labelnames, key, counts[-1]
+            yield self.name + '_sum', self.labelnames, key, total
+
+
+class Registry(object):
+    """
+    Holds the process metrics. Collectors are callables run before every
+    export, to refresh gauges read from elsewhere (e.g. the db pool).
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(),
+                  buckets=DEFAULT_BUCKETS):
+        return self.register(
+            Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def collect(self):
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception:
+                LOGGER.exception('Metrics collector failed')
+        with self._lock:
+            return list(self._metrics.values())
+
+    def render(self):
+        """Prometheus text exposition of every metric"""
+        lines = []
+        for metric in self.collect():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_http_server(port=None):
+    """Serves /metrics on METRICS_PORT in a daemon thread, 0 disables it"""
+    port = int(env.get('METRICS_PORT', 0)) if port is None else port
+    if not port:
+        return None
+    server = HTTPServer(('0.0.0.0', port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    LOGGER.info('Serving metrics on port %d', port)
+    return server
+
+
+# Metrics shared by the workers
+MESSAGES_RECEIVED = registry.counter(
+    'worker_messages_received_total', 'Messages delivered', ['queue'])
+MESSAGES_HANDLED = registry.counter(
+    'worker_messages_handled_total', 'Messages handled', ['queue', 'result'])
+MESSAGES_ACKED = registry.counter(
+    'worker_messages_acked_total', 'Messages acked', ['queue'])
+MESSAGES_NOT_ACKED = registry.counter(
+    'worker_messages_not_acked_total',
+    'Acks dropped because the channel was closed', ['queue'])
+ACK_FRAMES = registry.counter(
+    'worker_ack_frames_total', 'basic.ack frames sent', ['queue'])
+MESSAGES_DEFERRED = registry.counter(
+    'worker_messages_deferred_total', 'Messages deferred', ['queue'])
+MESSAGES_INFLIGHT = registry.gauge(
+    'worker_messages_inflight', 'Messages being handled', ['queue'])
+HANDLE_SECONDS = registry.histogram(
+    'worker_handle_seconds', 'Time spent in the message handler', ['queue'])
+DB_SECONDS = registry.histogram(
+    'worker_db_seconds', 'Time spent in db queries', ['queue'])
+HTTP_SECONDS = registry.histogram(
+    'worker_http_seconds', 'Time spent in http requests', ['queue', 'host'])
+STARTUP_SECONDS = registry.gauge(
+    'worker_startup_seconds', 'Time from process start to consuming',
+    ['queue'])
+
+
+def observe_http(response, *args, **kwargs):
+    """requests response hook recording the request latency"""
+    HTTP_SECONDS.observe(
+        response.elapsed.total_seconds(), queue=current_handler(),
+        host=response.url.split('/')[2] if '://' in response.url else '')
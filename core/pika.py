@@ -1,13 +1,66 @@
 import functools
 import logging
 import pika
+import pika.exceptions
 import uuid
-import json
+import signal
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from os import environ as env
+from core import codec, metrics, startup_time
+from core.codec import InvalidMessageError
+from core.ratelimit import TokenBucket
 
-LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
-              '-35s %(lineno) -5d: %(message)s')
 LOGGER = logging.getLogger(__name__)
 
+# Number of unacknowledged deliveries the broker pushes to a consumer and
+# number of threads handling them off the ioloop. Workers default to the
+# prefetch count so every prefetched message can be handled concurrently.
+AMQP_PREFETCH_COUNT = int(env.get('AMQP_PREFETCH_COUNT', 1))
+AMQP_CONSUMER_WORKERS = int(
+    env.get('AMQP_CONSUMER_WORKERS', AMQP_PREFETCH_COUNT))
+
+
+class AckBatcher(object):
+    """Collects finished delivery tags so they can be acked in bulk.
+
+    Handlers finish out of order, so a multiple ack is only sent for the
+    contiguous run of finished deliveries; a tag behind a still running
+    handler is acked on its own when the batch is flushed.
+    """
+
+    def __init__(self):
+        self._delivered = deque()
+        self._finished = set()
+
+    def __len__(self):
+        return len(self._finished)
+
+    def track(self, delivery_tag):
+        self._delivered.append(delivery_tag)
+
+    def finish(self, delivery_tag):
+        self._finished.add(delivery_tag)
+
+    def drain(self):
+        """Returns (multiple_tag, single_tags) to ack and forgets them"""
+        multiple_tag = None
+        while self._delivered and self._delivered[0] in self._finished:
+            multiple_tag = self._delivered.popleft()
+            self._finished.discard(multiple_tag)
+        single_tags = sorted(self._finished)
+        if single_tags:
+            self._delivered = deque(
+                tag for tag in self._delivered if tag not in self._finished)
+            self._finished.clear()
+        return multiple_tag, single_tags
+
+    def reset(self):
+        self._delivered.clear()
+        self._finished.clear()
+
 
 class PikaConsumer(object):
     EXCHANGE = 'default'
@@ -16,8 +69,21 @@ class PikaConsumer(object):
     ROUTING_KEY = 'default'
     EXCHANGE_DURABLE = True
     QUEUE_DURABLE = True
-
-    def __init__(self, amqp_url):
+    # Acks are flushed with multiple=True once this many handlers finished
+    # or ACK_BATCH_INTERVAL seconds passed; 1 acks every message at once
+    ACK_BATCH_SIZE = 1
+    ACK_BATCH_INTERVAL = 0.5
+    # Max messages handed to on_message per second, None disables the
+    # limit. Messages over the limit wait on the ioloop, still unacked
+    RATE_LIMIT = None
+    # core.messages.Payload subclass decode_message validates bodies with
+    PAYLOAD = None
+
+    # Scoped session of the subclass, every handler thread gets its own
+    # session which is removed after each message
+    _session = None
+
+    def __init__(self, amqp_url, prefetch_count=None, max_workers=None):
         self.should_reconnect = False
         self.was_consuming = False
 
@@ -27,9 +93,19 @@ class PikaConsumer(object):
         self._consumer_tag = None
         self._url = amqp_url
         self._consuming = False
-        # In production, experiment with higher prefetch values
-        # for higher consumer throughput
-        self._prefetch_count = 1
+        self._prefetch_count = max(1, prefetch_count or AMQP_PREFETCH_COUNT)
+        self._max_workers = max(1, max_workers or AMQP_CONSUMER_WORKERS)
+        # on_message runs on this pool so slow handlers never block the
+        # ioloop (and its heartbeats); channel calls are marshalled back
+        # with add_callback_threadsafe
+        self._executor = None
+        self._inflight = 0
+        self._inflight_lock = threading.Lock()
+        self._create_lock = threading.Lock()
+        self._acks = AckBatcher()
+        self._ack_timer = None
+        self._rate_limiter = TokenBucket(self.RATE_LIMIT) \
+            if self.RATE_LIMIT else None
 
     def connect(self):
         LOGGER.info('Connecting to %s', self._url)
@@ -57,8 +133,9 @@ class PikaConsumer(object):
 
     def on_connection_closed(self, _unused_connection, reason):
         self._channel = None
+        self._reset_acks()
         if self._closing:
-            self._connection.ioloop.stop()
+            self.stop_ioloop()
         else:
             LOGGER.warning(
                 'Connection closed, reconnect necessary: %s', reason)
@@ -84,6 +161,8 @@ class PikaConsumer(object):
 
     def on_channel_closed(self, channel, reason):
         LOGGER.warning('Channel %i was closed: %s', channel, reason)
+        # Delivery tags are scoped to the channel, pending acks are void
+        self._reset_acks()
         self.close_connection()
 
     def setup_exchange(self, exchange_name):
@@ -135,7 +214,11 @@ class PikaConsumer(object):
         LOGGER.info('Issuing consumer related RPC commands')
         self.add_on_cancel_callback()
         self._consumer_tag = self._channel.basic_consume(
-            self.QUEUE, self.on_message)
+            self.QUEUE, self.dispatch_message)
+        if not self.was_consuming:
+            LOGGER.info('Consuming %s, started in %.3fs',
+                        self.QUEUE, startup_time())
+            metrics.STARTUP_SECONDS.set(startup_time(), queue=self.QUEUE)
         self.was_consuming = True
         self._consuming = True
 
@@ -149,14 +232,179 @@ class PikaConsumer(object):
         if self._channel:
             self._channel.close()
 
+    def dispatch_message(self, channel, basic_deliver, properties, body):
+        metrics.MESSAGES_RECEIVED.inc(queue=self.QUEUE)
+        if self.batching_acks:
+            self._acks.track(basic_deliver.delivery_tag)
+        self._submit_message(channel, basic_deliver, properties, body)
+
+    def _submit_message(self, channel, basic_deliver, properties, body):
+        if self._closing or self._channel is None \
+                or not self._channel.is_open:
+            # The broker requeues it when the channel closes
+            return
+        if self._rate_limiter is not None:
+            wait = self._rate_limiter.try_consume()
+            if wait > 0:
+                self.call_later(wait, functools.partial(
+                    self._submit_message,
+                    channel, basic_deliver, properties, body))
+                return
+        self.start_handler(channel, basic_deliver, properties, body)
+
+    def start_handler(self, channel, basic_deliver, properties, body):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self._max_workers,
+                thread_name_prefix=self.QUEUE)
+        with self._inflight_lock:
+            self._inflight += 1
+        metrics.MESSAGES_INFLIGHT.inc(queue=self.QUEUE)
+        self._executor.submit(
+            self._handle_message, channel, basic_deliver, properties, body)
+
+    def defer_message(self, delay, channel, basic_deliver, properties, body):
+        """
+        Hands the message to on_message again after `delay` seconds without
+        acking it; may be called from handler threads
+        """
+        LOGGER.info('Deferring message # %s for %ss',
+                    basic_deliver.delivery_tag, delay)
+        metrics.MESSAGES_DEFERRED.inc(queue=self.QUEUE)
+        self.add_callback_threadsafe(functools.partial(
+            self.call_later, delay, functools.partial(
+                self._submit_message,
+                channel, basic_deliver, properties, body)))
+
+    def _handle_message(self, channel, basic_deliver, properties, body):
+        metrics.set_current_handler(self.QUEUE)
+        started_at = time.monotonic()
+        result = 'ok'
+        try:
+            self.on_message(channel, basic_deliver, properties, body)
+        except Exception:
+            result = 'error'
+            LOGGER.exception('Unhandled error in message handler # %s',
+                             basic_deliver.delivery_tag)
+        finally:
+            if self._session is not None:
+                # Hands the connection back to the pool between messages
+                self._session.remove()
+            self._observe_handled(started_at, result)
+            # Runs on the ioloop after the ack the handler scheduled
+            self.add_callback_threadsafe(self._on_message_done)
+
+    def _observe_handled(self, started_at, result):
+        metrics.HANDLE_SECONDS.observe(
+            time.monotonic() - started_at, queue=self.QUEUE)
+        metrics.MESSAGES_HANDLED.inc(queue=self.QUEUE, result=result)
+        metrics.MESSAGES_INFLIGHT.dec(queue=self.QUEUE)
+
+    def _on_message_done(self):
+        # A cancelled consumer waits for in-flight handlers before closing
+        # the channel, otherwise their acks would be lost
+        with self._inflight_lock:
+            self._inflight -= 1
+        if not self._consuming and self._closing and self._inflight == 0:
+            self.close_channel()
+
+    def add_callback_threadsafe(self, callback):
+        if self._connection is None or self._connection.is_closed:
+            return
+        self._connection.ioloop.add_callback_threadsafe(callback)
+
+    def call_later(self, delay, callback):
+        return self._connection.ioloop.call_later(delay, callback)
+
+    def remove_timeout(self, timer):
+        self._connection.ioloop.remove_timeout(timer)
+
+    def start_ioloop(self):
+        self._connection.ioloop.start()
+
+    def stop_ioloop(self):
+        self._connection.ioloop.stop()
+
     def on_message(self, _unused_channel, basic_deliver, properties, body):
-        LOGGER.info('Received message # %s from %s: %s',
-                    basic_deliver.delivery_tag, properties.app_id, body)
+        LOGGER.info('Received message # %s from %s, %d bytes',
+                    basic_deliver.delivery_tag, properties.app_id, len(body))
+        LOGGER.debug('Message # %s: %r', basic_deliver.delivery_tag, body)
         self.acknowledge_message(basic_deliver.delivery_tag)
 
+    def decode_message(self, properties, body):
+        """
+        Decodes the body by its content type into a PAYLOAD instance, or a
+        plain object without PAYLOAD. Raises InvalidMessageError.
+        """
+        return codec.decode(body, properties.content_type, self.PAYLOAD)
+
+    def get_or_create(self, name, factory):
+        """
+        Returns the attribute `name`, set to factory() on first use. Handler
+        threads may ask at the same time, only one of them runs factory
+        """
+        value = getattr(self, name)
+        if value is None:
+            with self._create_lock:
+                value = getattr(self, name)
+                if value is None:
+                    value = factory()
+                    setattr(self, name, value)
+        return value
+
     def acknowledge_message(self, delivery_tag):
-        LOGGER.info('Acknowledging message %s', delivery_tag)
-        self._channel.basic_ack(delivery_tag)
+        self.add_callback_threadsafe(
+            functools.partial(self._basic_ack, delivery_tag))
+
+    def _basic_ack(self, delivery_tag):
+        if self._channel is None or not self._channel.is_open:
+            LOGGER.warning('Channel closed, can not ack message %s',
+                           delivery_tag)
+            metrics.MESSAGES_NOT_ACKED.inc(queue=self.QUEUE)
+            return
+        metrics.MESSAGES_ACKED.inc(queue=self.QUEUE)
+        if not self.batching_acks:
+            LOGGER.debug('Acknowledging message %s', delivery_tag)
+            self._channel.basic_ack(delivery_tag)
+            metrics.ACK_FRAMES.inc(queue=self.QUEUE)
+            return
+        self._acks.finish(delivery_tag)
+        # Never wait for more acks than the broker is willing to deliver
+        if len(self._acks) >= min(self.ACK_BATCH_SIZE, self._prefetch_count):
+            self.flush_acks()
+        elif self._ack_timer is None:
+            self._ack_timer = self.call_later(
+                self.ACK_BATCH_INTERVAL, self._on_ack_timer)
+
+    @property
+    def batching_acks(self):
+        return self.ACK_BATCH_SIZE > 1
+
+    def _on_ack_timer(self):
+        self._ack_timer = None
+        self.flush_acks()
+
+    def flush_acks(self):
+        if self._ack_timer is not None:
+            self.remove_timeout(self._ack_timer)
+            self._ack_timer = None
+        if self._channel is None or not self._channel.is_open:
+            return
+        multiple_tag, single_tags = self._acks.drain()
+        if multiple_tag is not None:
+            LOGGER.debug('Acknowledging messages up to %s', multiple_tag)
+            self._channel.basic_ack(multiple_tag, multiple=True)
+            metrics.ACK_FRAMES.inc(queue=self.QUEUE)
+        for delivery_tag in single_tags:
+            LOGGER.debug('Acknowledging message %s', delivery_tag)
+            self._channel.basic_ack(delivery_tag)
+        metrics.ACK_FRAMES.inc(len(single_tags), queue=self.QUEUE)
+
+    def _reset_acks(self):
+        if self._ack_timer is not None and self._connection is not None:
+            self.remove_timeout(self._ack_timer)
+        self._ack_timer = None
+        self._acks.reset()
 
     def stop_consuming(self):
         if self._channel:
@@ -170,14 +418,24 @@ class PikaConsumer(object):
         LOGGER.info(
             'RabbitMQ acknowledged the cancellation of the consumer: %s',
             userdata)
+        if self._inflight > 0:
+            LOGGER.info('Waiting for %d in-flight messages', self._inflight)
+            return
         self.close_channel()
 
     def close_channel(self):
+        if self._channel is None or not self._channel.is_open:
+            return
+        self.flush_acks()
         LOGGER.info('Closing the channel')
         self._channel.close()
 
     def publish_message(
             self, message, exchange=None, routing_key=None, properties=None):
+        self.add_callback_threadsafe(functools.partial(
+            self._basic_publish, message, exchange, routing_key, properties))
+
+    def _basic_publish(self, message, exchange, routing_key, properties):
         if self._channel is None or not self._channel.is_open:
             return
         if routing_key is None:
@@ -185,61 +443,362 @@ class PikaConsumer(object):
         if exchange is None:
             exchange = self.EXCHANGE
         if properties is None:
-            properties = pika.BasicProperties(
-                content_type='application/json',
-                message_id=str(uuid.uuid4()))
-        self._channel.basic_publish(
-            exchange,
-            routing_key,
-            json.dumps(message, ensure_ascii=False), properties)
+            properties = pika.BasicProperties(message_id=str(uuid.uuid4()))
+        body, properties.content_type = codec.encode(
+            message, properties.content_type)
+        self._channel.basic_publish(exchange, routing_key, body, properties)
 
     def run(self):
         self._connection = self.connect()
-        self._connection.ioloop.start()
+        self.start_ioloop()
 
     def stop(self):
         if not self._closing:
             self._closing = True
             LOGGER.info('Stopping')
+            self.flush_acks()
             if self._consuming:
                 self.stop_consuming()
-                self._connection.ioloop.start()
+                self.start_ioloop()
             else:
-                self._connection.ioloop.stop()
+                self.stop_ioloop()
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
             LOGGER.info('Stopped')
 
 
+class Message(object):
+    __slots__ = ('delivery_tag', 'redelivered', 'routing_key', 'properties',
+                 'body')
+
+    def __init__(self, basic_deliver, properties, body):
+        self.delivery_tag = basic_deliver.delivery_tag
+        self.redelivered = basic_deliver.redelivered
+        self.routing_key = basic_deliver.routing_key
+        self.properties = properties
+        self.body = body
+
+
+class AsyncConsumer(PikaConsumer):
+    """
+    Consumer whose handler is a coroutine: `async def handle(message)`.
+
+    Runs on pika's asyncio adapter. Every delivery becomes a task on the
+    connection's event loop, a semaphore sized to the prefetch count
+    bounds the running handlers and the message is acked once handle
+    returns or raises. stop() cancels the consumer, waits for the running
+    handlers and then closes the channel.
+    """
+
+    def __init__(self, amqp_url, prefetch_count=None, loop=None):
+        super().__init__(amqp_url, prefetch_count=prefetch_count)
+        self._loop = loop
+        self._semaphore = None
+        self._tasks = set()
+
+    def connect(self):
+        # asyncio is only imported by the consumers using it
+        import asyncio
+        from pika.adapters.asyncio_connection import AsyncioConnection
+        LOGGER.info('Connecting to %s', self._url)
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        return AsyncioConnection(
+            parameters=pika.URLParameters(self._url),
+            on_open_callback=self.on_connection_open,
+            on_open_error_callback=self.on_connection_open_error,
+            on_close_callback=self.on_connection_closed,
+            custom_ioloop=self._loop)
+
+    def add_callback_threadsafe(self, callback):
+        if self._loop is None or self._loop.is_closed():
+            return
+        self._loop.call_soon_threadsafe(callback)
+
+    def call_later(self, delay, callback):
+        return self._loop.call_later(delay, callback)
+
+    def remove_timeout(self, timer):
+        timer.cancel()
+
+    def start_ioloop(self):
+        self._loop.run_forever()
+
+    def stop_ioloop(self):
+        self._loop.stop()
+
+    def start_handler(self, channel, basic_deliver, properties, body):
+        with self._inflight_lock:
+            self._inflight += 1
+        metrics.MESSAGES_INFLIGHT.inc(queue=self.QUEUE)
+        task = self._loop.create_task(
+            self._handle(Message(basic_deliver, properties, body)))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _handle(self, message):
+        import asyncio
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._prefetch_count)
+        started_at = time.monotonic()
+        result = 'ok'
+        try:
+            async with self._semaphore:
+                await self.handle(message)
+        except Exception:
+            result = 'error'
+            LOGGER.exception('Unhandled error in message handler # %s',
+                             message.delivery_tag)
+        finally:
+            self._observe_handled(started_at, result)
+            # Already on the loop, ack before a pending close can run
+            self._basic_ack(message.delivery_tag)
+            self._on_message_done()
+
+    async def handle(self, message):
+        LOGGER.info('Received message # %s from %s, %d bytes',
+                    message.delivery_tag, message.properties.app_id,
+                    len(message.body))
+
+
+class _Confirmation(object):
+    """Outcome of one publish, set on the publisher's ioloop"""
+
+    def __init__(self, message_id):
+        self.message_id = message_id
+        self.result = None
+        self._event = threading.Event()
+
+    def set(self, result):
+        self.result = result
+        self._event.set()
+
+    def wait(self, timeout):
+        if not self._event.wait(timeout):
+            return 'timeout'
+        return self.result
+
+
 class PikaPublisher(object):
+    """
+    Publishes from any thread over one SelectConnection whose ioloop runs
+    on a background thread. Messages are published mandatory; with
+    CONFIRM_DELIVERY publish() waits for the broker's confirm and returns
+    False when the message was nacked or returned as unroutable.
+    publish_many() sends the whole batch before waiting, the broker then
+    confirms it with a few multiple acks.
+    """
     EXCHANGE = 'default'
     EXCHANGE_TYPE = 'direct'
     QUEUE = 'default'
     ROUTING_KEY = 'default'
     EXCHANGE_DURABLE = True
     QUEUE_DURABLE = True
-
-    _connection = None
-    _url = None
-
-    def __init__(self, amqp_url):
+    CONFIRM_DELIVERY = False
+    # Number of reconnect attempts when the connection dropped
+    PUBLISH_RETRIES = 1
+    # Seconds to wait for the connection and for a confirm
+    PUBLISH_TIMEOUT = 30
+    # None publishes core.codec.AMQP_CONTENT_TYPE
+    CONTENT_TYPE = None
+
+    def __init__(self, amqp_url, confirm_delivery=None):
         self._url = amqp_url
-        self._connection = self.connect()
+        self._confirm_delivery = self.CONFIRM_DELIVERY \
+            if confirm_delivery is None else confirm_delivery
+        self._lock = threading.Lock()
+        self._connection = None
+        self._channel = None
+        self._thread = None
+        self._ready = None
+        # Only touched on the ioloop
+        self._delivery_tag = 0
+        self._pending = {}
+        self._returned = set()
+        self.open()
 
     def connect(self):
-        parameters = pika.URLParameters(self._url)
-        return pika.BlockingConnection(parameters)
+        return pika.SelectConnection(
+            pika.URLParameters(self._url),
+            on_open_callback=self.on_connection_open,
+            on_open_error_callback=self.on_connection_open_error,
+            on_close_callback=self.on_connection_closed)
 
-    def channel(self):
-        if (self._connection is None or self._connection.is_closed):
-            self._connection = self.connect()
-        return self._connection.channel()
+    def open(self):
+        """Connects unless the channel is open, returns whether it is"""
+        with self._lock:
+            if self._channel is not None and self._channel.is_open:
+                return True
+            if self._ready is None or self._ready.is_set():
+                # Never connected, or the last connection is gone and its
+                # ioloop is stopping
+                if self._thread is not None:
+                    self._thread.join(self.PUBLISH_TIMEOUT)
+                self._ready = threading.Event()
+                self._connection = self.connect()
+                self._thread = threading.Thread(
+                    target=self._connection.ioloop.start,
+                    name='publisher', daemon=True)
+                self._thread.start()
+            ready = self._ready
+        ready.wait(self.PUBLISH_TIMEOUT)
+        channel = self._channel
+        return channel is not None and channel.is_open
+
+    def on_connection_open(self, connection):
+        connection.channel(on_open_callback=self.on_channel_open)
+
+    def on_connection_open_error(self, connection, err):
+        LOGGER.error('Publisher connection open failed: %s', err)
+        self._stop(connection)
+
+    def on_connection_closed(self, connection, reason):
+        if not isinstance(reason,
+                          pika.exceptions.ConnectionClosedByClient):
+            LOGGER.warning('Publisher connection closed: %s', reason)
+        self._stop(connection)
+
+    def _stop(self, connection):
+        self._channel = None
+        self._fail_pending('closed')
+        self._ready.set()
+        connection.ioloop.stop()
 
-    def publish(self, message):
-        channel = self.channel()
+    def on_channel_open(self, channel):
+        channel.add_on_close_callback(self.on_channel_closed)
+        channel.add_on_return_callback(self.on_message_returned)
+        self._delivery_tag = 0
+        if self._confirm_delivery:
+            channel.confirm_delivery(
+                self.on_delivery_confirmation,
+                lambda _frame: self._on_channel_ready(channel))
+        else:
+            self._on_channel_ready(channel)
+
+    def _on_channel_ready(self, channel):
+        self._channel = channel
+        self._ready.set()
+
+    def on_channel_closed(self, channel, reason):
+        if not isinstance(reason, pika.exceptions.ChannelClosedByClient):
+            LOGGER.warning('Publisher channel closed: %s', reason)
+        self._channel = None
+        self._fail_pending('closed')
+        if self._connection.is_open:
+            self._connection.close()
+
+    def on_message_returned(self, channel, method, properties, body):
+        LOGGER.error('Message %s returned: %s', properties.message_id,
+                     method.reply_text)
+        if self._confirm_delivery:
+            # RabbitMQ sends the return before the ack of the message
+            self._returned.add(properties.message_id)
+
+    def on_delivery_confirmation(self, frame):
+        method = frame.method
+        if method.multiple:
+            tags = [tag for tag in self._pending
+                    if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        for tag in tags:
+            confirmation = self._pending.pop(tag, None)
+            if confirmation is None:
+                continue
+            if confirmation.message_id in self._returned:
+                self._returned.discard(confirmation.message_id)
+                confirmation.set('returned')
+            else:
+                confirmation.set('ack' if acked else 'nack')
+
+    def _fail_pending(self, result):
+        pending, self._pending = self._pending, {}
+        self._returned.clear()
+        for confirmation in pending.values():
+            confirmation.set(result)
+
+    def _basic_publish(self, body, content_type, routing_key, confirmation):
+        channel = self._channel
+        if channel is None or not channel.is_open:
+            confirmation.set('closed')
+            return
         channel.basic_publish(
-            self.EXCHANGE, self.ROUTING_KEY,
-            json.dumps(message, ensure_ascii=False),
+            self.EXCHANGE, routing_key or self.ROUTING_KEY, body,
             pika.BasicProperties(
-                content_type='application/json',
-                message_id=str(uuid.uuid4()),
-                delivery_mode=1))
-        channel.close()
+                content_type=content_type,
+                message_id=confirmation.message_id,
+                delivery_mode=1),
+            mandatory=True)
+        if self._confirm_delivery:
+            self._delivery_tag += 1
+            self._pending[self._delivery_tag] = confirmation
+        else:
+            confirmation.set('ack')
+
+    def _send(self, encoded, routing_key):
+        """Hands the message to the ioloop, returns its confirmation"""
+        confirmation = _Confirmation(str(uuid.uuid4()))
+        if not self.open():
+            confirmation.set('closed')
+            return confirmation
+        self._connection.ioloop.add_callback_threadsafe(functools.partial(
+            self._basic_publish, encoded[0], encoded[1], routing_key,
+            confirmation))
+        return confirmation
+
+    def _published(self, confirmation, encoded, routing_key):
+        """Waits for the confirmation, republishes after a lost
+        connection"""
+        attempt = 0
+        while True:
+            result = confirmation.wait(self.PUBLISH_TIMEOUT)
+            if result == 'ack':
+                return True
+            if result != 'closed' or attempt >= self.PUBLISH_RETRIES:
+                LOGGER.error('Message was not confirmed: %s', result)
+                return False
+            attempt += 1
+            LOGGER.warning('Publisher connection lost, republishing')
+            confirmation = self._send(encoded, routing_key)
+
+    def publish(self, message, routing_key=None):
+        """Publishes a dict or core.messages.Payload"""
+        encoded = codec.encode(message, self.CONTENT_TYPE)
+        return self._published(self._send(encoded, routing_key), encoded,
+                               routing_key)
+
+    def publish_many(self, messages, routing_key=None):
+        """Publishes all messages, then waits for their confirms. Returns
+        the number of messages accepted by the broker"""
+        encoded = [codec.encode(message, self.CONTENT_TYPE)
+                   for message in messages]
+        confirmations = [self._send(item, routing_key) for item in encoded]
+        return sum(self._published(confirmation, item, routing_key)
+                   for confirmation, item in zip(confirmations, encoded))
+
+    def close(self):
+        with self._lock:
+            connection, thread = self._connection, self._thread
+            self._thread = None
+        if thread is None or not thread.is_alive():
+            return
+        connection.ioloop.add_callback_threadsafe(
+            functools.partial(self._close_connection, connection))
+        thread.join(self.PUBLISH_TIMEOUT)
+
+    def _close_connection(self, connection):
+        if not (connection.is_closing or connection.is_closed):
+            connection.close()
+
+
+def run_consumer(consumer):
+    """Runs the consumer until SIGTERM or Ctrl-C, then drains it"""
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    metrics.start_http_server()
+    try:
+        consumer.run()
+    except KeyboardInterrupt:
+        consumer.stop()
@@ -0,0 +1,31 @@
+import threading
+import time
+
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket which never blocks: try_consume takes a token
+    and returns 0, or returns how many seconds to wait for the next token
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1, rate))
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(
+            self.capacity,
+            self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def try_consume(self, tokens=1):
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0
+            return (tokens - self._tokens) / self.rate
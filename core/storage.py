@@ -0,0 +1,200 @@
+import base64
+import gzip
+import logging
+from os import environ as env, makedirs, path, remove
+
+LOGGER = logging.getLogger(__name__)
+
+# S3 rejects multipart parts smaller than 5MB except the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+EXPORT_PART_SIZE = max(
+    MIN_PART_SIZE, int(env.get('EXPORT_PART_SIZE', 8 * 1024 * 1024)))
+
+
+class ExportSink(object):
+    """
+    Streams lines to storage in parts of `part_size` bytes.
+
+    With `compress` every write becomes its own gzip member; concatenated
+    members are a valid gzip stream, so parts can be cut anywhere between
+    writes. Use it as a context manager: the upload is completed when the
+    block exits and aborted when it raises.
+
+    state() returns a JSON serializable snapshot which restore() accepts,
+    so an interrupted export can keep appending to the same upload.
+    """
+
+    def __init__(self, key, compress=False, part_size=EXPORT_PART_SIZE):
+        self.key = key
+        self.compress = compress
+        self.part_size = part_size
+        self.size = 0
+        self._buffer = bytearray()
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    def write(self, lines):
+        data = ('\n'.join(lines) + '\n').encode('utf-8')
+        if self.compress:
+            data = gzip.compress(data)
+        self._buffer.extend(data)
+        self.size += len(data)
+        if len(self._buffer) >= self.part_size:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self.write_part(bytes(self._buffer))
+            self._buffer = bytearray()
+
+    def close(self):
+        if self._closed:
+            return
+        self.flush()
+        self._closed = True
+        self.complete()
+
+    def abort(self):
+        if self._closed:
+            return
+        self._buffer = bytearray()
+        self._closed = True
+        self.discard()
+
+    def state(self):
+        return {
+            'size': self.size,
+            'buffer': base64.b64encode(bytes(self._buffer)).decode('ascii'),
+        }
+
+    def restore(self, state):
+        self.size = state['size']
+        self._buffer = bytearray(base64.b64decode(state['buffer']))
+
+    def abort_incomplete(self):
+        """Drops what an earlier run left for `key` without a checkpoint"""
+
+    def write_part(self, data):
+        raise NotImplementedError
+
+    def complete(self):
+        raise NotImplementedError
+
+    def discard(self):
+        raise NotImplementedError
+
+
+class S3MultipartSink(ExportSink):
+    def __init__(self, client, bucket, key, **kwargs):
+        super().__init__(key, **kwargs)
+        self.client = client
+        self.bucket = bucket
+        self.upload_id = None
+        self.parts = []
+
+    def write_part(self, data):
+        if self.upload_id is None:
+            extra = {'ContentType': 'text/csv'}
+            if self.compress:
+                extra['ContentEncoding'] = 'gzip'
+            self.upload_id = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, **extra)['UploadId']
+        part_number = len(self.parts) + 1
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            PartNumber=part_number, Body=data)
+        self.parts.append(
+            {'PartNumber': part_number, 'ETag': response['ETag']})
+        LOGGER.info('Uploaded part %d of %s', part_number, self.key)
+
+    def state(self):
+        state = super().state()
+        state.update({'upload_id': self.upload_id, 'parts': self.parts})
+        return state
+
+    def restore(self, state):
+        # Parts uploaded after the snapshot are overwritten, S3 keeps the
+        # last upload of a part number
+        super().restore(state)
+        self.upload_id = state['upload_id']
+        self.parts = list(state['parts'])
+
+    def abort_incomplete(self):
+        # Jobs that are never retried are covered by the bucket rule in
+        # migrations/export_bucket_lifecycle.json, applied with
+        # aws s3api put-bucket-lifecycle-configuration
+        response = self.client.list_multipart_uploads(
+            Bucket=self.bucket, Prefix=self.key)
+        for upload in response.get('Uploads', []):
+            if upload['Key'] != self.key:
+                continue
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key,
+                UploadId=upload['UploadId'])
+            LOGGER.info('Aborted stale upload of %s', self.key)
+
+    def complete(self):
+        if self.upload_id is None:
+            return
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': self.parts})
+        LOGGER.info('Upload of %s completed', self.key)
+
+    def discard(self):
+        if self.upload_id is None:
+            return
+        self.client.abort_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        LOGGER.info('Upload of %s aborted', self.key)
+
+
+class LocalSink(ExportSink):
+    """Writes parts to `directory`/`key`, for tests and local runs"""
+
+    def __init__(self, directory, key, **kwargs):
+        super().__init__(key, **kwargs)
+        self.filepath = path.join(directory, key)
+        makedirs(directory, exist_ok=True)
+        self.parts = 0
+        self.written = 0
+
+    def write_part(self, data):
+        mode = 'ab' if self.parts > 0 else 'wb'
+        with open(self.filepath, mode) as f:
+            f.write(data)
+        self.parts += 1
+        self.written += len(data)
+
+    def state(self):
+        state = super().state()
+        state.update({'parts': self.parts, 'written': self.written})
+        return state
+
+    def restore(self, state):
+        super().restore(state)
+        self.parts = state['parts']
+        self.written = state['written']
+        if path.exists(self.filepath):
+            # Drop parts written after the snapshot
+            with open(self.filepath, 'r+b') as f:
+                f.truncate(self.written)
+
+    def abort_incomplete(self):
+        self.discard()
+
+    def complete(self):
+        pass
+
+    def discard(self):
+        if path.exists(self.filepath):
+            remove(self.filepath)
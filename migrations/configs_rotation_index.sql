@@ -0,0 +1,7 @@
+-- Index behind the credential rotation queries: claiming the least
+-- recently used available config and counting available ones.
+-- create_all does not add indexes to existing tables, run this once.
+-- The claim selects FOR UPDATE SKIP LOCKED, which needs MySQL 8.0 or
+-- later (or MariaDB 10.6).
+CREATE INDEX idx_config_rotation
+    ON configs (`key`, status, expired_to, updated_timestamp);
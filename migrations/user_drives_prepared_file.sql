@@ -0,0 +1,3 @@
+-- Warm-up progress of exports, written only with EXPORT_PREPARE_UPLOAD=1.
+-- Run before enabling it.
+ALTER TABLE user_drives ADD COLUMN prepared_file INT NULL DEFAULT 0;
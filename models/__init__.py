@@ -1,7 +1,7 @@
 from datetime import datetime, timedelta
 from sqlalchemy import Column, Integer, String, DateTime, BigInteger, Text, \
-    Index
-from sqlalchemy.orm import load_only
+    Index, func
+from sqlalchemy.orm import deferred, load_only, synonym
 from sqlalchemy.exc import SQLAlchemyError
 
 from core.db import Base
@@ -36,18 +36,66 @@ class Config(Base, BaseModelMixin):
     expired_to = Column(Integer, nullable=False)
     status = Column(Integer, default=ACTIVE_STATUS)
     updated_timestamp = Column(BigInteger, nullable=True)
+    # expired_to is the unix time from which a config can be used again,
+    # limit_cookie pushes it to tomorrow
+    available_after = synonym('expired_to')
+
+    # Existing databases get it from migrations/configs_rotation_index.sql
+    __table_args__ = (
+        Index('idx_config_rotation', key, status, expired_to,
+              updated_timestamp),
+    )
 
     @classmethod
-    def get_one_by_key(cls, session, key):
+    def available_filter(cls, key):
         now = int(datetime.timestamp(datetime.now()))
-        config = session.query(cls).filter_by(
-            key=key,
-            status=cls.ACTIVE_STATUS).filter(
-            (cls.expired_to == None) | (
-                cls.expired_to < now)
+        return (cls.key == key) & (cls.status == cls.ACTIVE_STATUS) & (
+            cls.available_after <= now)
+
+    @classmethod
+    def available_query(cls, session, key):
+        return session.query(cls).filter(
+            cls.available_filter(key)
         ).order_by(
             cls.updated_timestamp.asc()
-        ).options(load_only('id', 'value', 'group')).first()
+        ).options(load_only('id', 'value', 'group'))
+
+    @classmethod
+    def count_available(cls, session, key):
+        # Only touches columns of idx_config_rotation (and the primary key),
+        # so MySQL answers it from the index
+        count = session.query(func.count(cls.id)).filter(
+            cls.available_filter(key)).scalar()
+        session.commit()
+        return count
+
+    @classmethod
+    def next_available_at(cls, session, key):
+        """Returns the unix time the next limited config becomes usable"""
+        now = int(datetime.timestamp(datetime.now()))
+        available_at = session.query(func.min(cls.available_after)).filter(
+            (cls.key == key) & (cls.status == cls.ACTIVE_STATUS) & (
+                cls.available_after > now)).scalar()
+        session.commit()
+        return available_at
+
+    @classmethod
+    def claim_query(cls, session, key):
+        """
+        Locks the matched rows until the transaction ends; rows locked by
+        another worker are skipped so concurrent workers claim different
+        configs instead of all picking the least recently used one
+        """
+        return cls.available_query(session, key).with_for_update(
+            skip_locked=True)
+
+    @classmethod
+    def get_one_by_key(cls, session, key):
+        try:
+            config = cls.claim_query(session, key).first()
+        except SQLAlchemyError:
+            session.rollback()
+            raise
 
         if config is not None:
             # Update config timestamp
@@ -65,6 +113,28 @@ class Config(Base, BaseModelMixin):
             return config_dict
         return None
 
+    @classmethod
+    def lease_by_key(cls, session, key, limit):
+        """
+        Claims the `limit` least recently used configs in one transaction
+        and returns them as dictionaries, least recently used first
+        """
+        try:
+            configs = cls.claim_query(session, key).limit(limit).all()
+            config_dicts = [
+                {'group': config.group, 'value': config.value}
+                for config in configs]
+            if configs:
+                session.query(cls).filter(
+                    cls.id.in_([config.id for config in configs])
+                ).update({'updated_timestamp': get_unix_time()},
+                         synchronize_session=False)
+            session.commit()
+            return config_dicts
+        except SQLAlchemyError:
+            session.rollback()
+            raise
+
     @classmethod
     def disable_cookie(cls, session, email):
         # Gets cookie
@@ -121,6 +191,12 @@ class UserDrive(Base):
     user_id = Column(Integer, nullable=False)
     drive_id = Column(String(255), nullable=False)
     total_file = Column(Integer, nullable=True, default=0)
+    # Exported files already warmed up through the api. Added by
+    # migrations/user_drives_prepared_file.sql and only written with
+    # EXPORT_PREPARE_UPLOAD on: deferred so queries do not select it, a
+    # server default so inserts leave it out
+    prepared_file = deferred(
+        Column(Integer, nullable=True, server_default='0'))
     status = Column(String(128), nullable=True, default=PENDING_STATUS)
     api_key = Column(String(128), nullable=True)
     created_date = Column(DateTime, nullable=True,
@@ -0,0 +1,65 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy.orm import sessionmaker
+
+from core.db import get_engine, SQLALCHEMY_DATABASE_URI, \
+    SQLALCHEMY_POOL_SIZE, SQLALCHEMY_MAX_OVERFLOW
+from models import Config
+
+
+class AsyncDataAccess(object):
+    """
+    asyncio front for the models operations.
+
+    SQLAlchemy 1.3 and PyMySQL only block, so every call runs with a
+    session of its own on a thread pool sized like the engine pool and the
+    event loop only awaits its result; many calls overlap up to the pool
+    size. Any SQLAlchemy URL works, e.g. a sqlite file for tests.
+    """
+
+    def __init__(self, url=SQLALCHEMY_DATABASE_URI, max_workers=None):
+        self.engine = get_engine(url)
+        self._session_factory = sessionmaker(bind=self.engine)
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers or (
+                SQLALCHEMY_POOL_SIZE + max(0, SQLALCHEMY_MAX_OVERFLOW)),
+            thread_name_prefix='db')
+
+    def _call(self, func, *args, **kwargs):
+        session = self._session_factory()
+        try:
+            return func(session, *args, **kwargs)
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    async def run(self, func, *args, **kwargs):
+        """Awaits func(session, *args, **kwargs)"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(
+            self._call, func, *args, **kwargs))
+
+    async def get_one_by_key(self, key):
+        return await self.run(Config.get_one_by_key, key)
+
+    async def lease_by_key(self, key, limit):
+        return await self.run(Config.lease_by_key, key, limit)
+
+    async def count_available(self, key):
+        return await self.run(Config.count_available, key)
+
+    async def next_available_at(self, key):
+        return await self.run(Config.next_available_at, key)
+
+    async def disable_cookie(self, email):
+        return await self.run(Config.disable_cookie, email)
+
+    async def limit_cookie(self, email):
+        return await self.run(Config.limit_cookie, email)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,75 @@
+import threading
+import time
+from collections import deque
+from os import environ as env
+
+from models import Config, GDRIVE_COOKIE_KEY
+
+# Number of configs reserved per key and how long (seconds) a worker keeps
+# handing them out before reserving a fresh block
+CREDENTIAL_LEASE_SIZE = int(env.get('CREDENTIAL_LEASE_SIZE', 10))
+CREDENTIAL_LEASE_TTL = int(env.get('CREDENTIAL_LEASE_TTL', 60))
+
+
+class CredentialLease(object):
+    def __init__(self, configs, ttl):
+        self.configs = deque(configs)
+        self.expires_at = time.monotonic() + ttl
+
+    @property
+    def expired(self):
+        return not self.configs or time.monotonic() >= self.expires_at
+
+
+class CredentialCache(object):
+    """
+    Keeps a block of api keys / cookies per config key in memory.
+
+    Blocks are reserved with Config.lease_by_key, which bumps the rows
+    timestamps, so workers still rotate through the least recently used
+    configs; inside a block configs are handed out round-robin.
+    """
+
+    def __init__(self, lease_size=CREDENTIAL_LEASE_SIZE,
+                 lease_ttl=CREDENTIAL_LEASE_TTL):
+        self.lease_size = lease_size
+        self.lease_ttl = lease_ttl
+        self._leases = {}
+        self._lock = threading.Lock()
+
+    def get(self, session, key):
+        with self._lock:
+            lease = self._leases.get(key)
+            if lease is None or lease.expired:
+                lease = CredentialLease(
+                    Config.lease_by_key(session, key, self.lease_size),
+                    self.lease_ttl)
+                self._leases[key] = lease
+            if not lease.configs:
+                return None
+            config = lease.configs.popleft()
+            lease.configs.append(config)
+            return dict(config)
+
+    def evict(self, key, group):
+        with self._lock:
+            lease = self._leases.get(key)
+            if lease is not None:
+                lease.configs = deque(
+                    config for config in lease.configs
+                    if config['group'] != group)
+
+    def clear(self):
+        with self._lock:
+            self._leases.clear()
+
+    def disable_cookie(self, session, email):
+        self.evict(GDRIVE_COOKIE_KEY, email)
+        Config.disable_cookie(session, email)
+
+    def limit_cookie(self, session, email):
+        self.evict(GDRIVE_COOKIE_KEY, email)
+        Config.limit_cookie(session, email)
+
+
+credentials = CredentialCache()
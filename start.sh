@@ -1,3 +1,13 @@
 #!/bin/sh
 
-python -m workers.${WORKER}
+# Without a mounted volume exports still run, but only resume in this
+# container
+mkdir -p "${CHECKPOINT_DIR:-./tmp/checkpoints}"
+
+# WORKERS="cookie:2,register,recheck" runs several workers in this
+# container under the supervisor, otherwise the single WORKER runs
+if [ -n "${WORKERS}" ]; then
+    exec python -m workers.supervisor
+fi
+
+exec python -m workers.${WORKER}
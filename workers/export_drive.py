@@ -1,16 +1,27 @@
 import logging
-from os import environ as env, mkdir, path, remove
-import json
-import csv
+from os import environ as env
+import math
+import queue
+import time
+import threading
 import concurrent.futures
-import boto3
+from collections import deque
 import requests
-from urllib.parse import urlencode
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from sqlalchemy.exc import SQLAlchemyError
-from core.pika import PikaConsumer
+from core import codec, metrics
+from core.pika import PikaConsumer, InvalidMessageError, run_consumer
+from core.logs import setup_logging
+from core.messages import ExportPayload
 from core.db import get_engine_session
+from core.storage import S3MultipartSink, LocalSink
+from core.checkpoint import FileCheckpointStore
+from core.dedup import IdSet, BloomFilter, id_set_from_state
 from core.utils import get_unix_time
-from models import Config, UserDrive, BalanceLog, GDRIVE_API_KEY
+from core.ratelimit import TokenBucket
+from models import UserDrive, BalanceLog, GDRIVE_API_KEY
+from models.credentials import credentials
 
 
 LOG_FORMAT = (
@@ -24,7 +35,42 @@ AWS_ACCESS_KEY_ID = env.get("AWS_ACCESS_KEY_ID")
 AWS_SECRET_ACCESS_KEY = env.get("AWS_SECRET_ACCESS_KEY")
 AWS_REGION = env.get("AWS_REGION")
 API_URL = env.get("API_URL", "http://localhost:5000")
+# "s3" streams exports to S3_BUCKET, "local" writes them to TMP_DIR
+EXPORT_STORAGE = env.get("EXPORT_STORAGE", "s3")
+EXPORT_GZIP = env.get("EXPORT_GZIP", "0") == "1"
+# Warm exported links up through API_URL/api/get instead of charging the
+# export, at most PREPARE_UPLOAD_RATE requests per second per export.
+# Needs the column added by migrations/user_drives_prepared_file.sql
+PREPARE_UPLOAD = env.get("EXPORT_PREPARE_UPLOAD", "0") == "1"
+PREPARE_UPLOAD_WORKERS = int(env.get("PREPARE_UPLOAD_WORKERS", 8))
+PREPARE_UPLOAD_RATE = float(env.get("PREPARE_UPLOAD_RATE", 20))
+PREPARE_UPLOAD_RETRY = 3
+PREPARE_UPLOAD_TIMEOUT = (5, 60)
+# "hashed" remembers a 64 bit hash of every emitted file id, "bloom"
+# bounds the memory to EXPORT_BLOOM_CAPACITY ids; both drop a unique file
+# on a collision, the bloom filter far more often
+EXPORT_DEDUP = env.get("EXPORT_DEDUP", "hashed")
+EXPORT_BLOOM_CAPACITY = int(env.get("EXPORT_BLOOM_CAPACITY", 5000000))
+# Seconds between progress writes of a running export
+EXPORT_PROGRESS_INTERVAL = int(env.get("EXPORT_PROGRESS_INTERVAL", 10))
+# Seconds between crawl checkpoints, a redelivered export resumes from
+# the last one
+EXPORT_CHECKPOINT_INTERVAL = int(env.get("EXPORT_CHECKPOINT_INTERVAL", 30))
 PAGE_SIZE = 1000
+DRIVE_API_URL = env.get(
+    "DRIVE_API_URL", "https://www.googleapis.com/drive/v3/files"
+)
+# Only what the crawler reads, keeps list responses small
+DRIVE_API_FIELDS = "nextPageToken,files(id,mimeType)"
+# Folders ORed into one list query and the longest query sent, Drive
+# rejects list requests whose URL gets too long
+MAX_FOLDER_BATCH = int(env.get("MAX_FOLDER_BATCH", 50))
+DRIVE_QUERY_MAX_LENGTH = 4000
+# (connect, read) timeouts in seconds
+DRIVE_API_TIMEOUT = (5, 60)
+# Retries with exponential backoff on connection errors and 5xx. Rate
+# limits (429) are left to DriveCrawler, which lowers its concurrency
+DRIVE_API_RETRY = int(env.get("DRIVE_API_RETRY", 5))
 DRIVE_FILE_MIME_TYPES = {
     "g_file": "application/vnd.google-apps.file",
     "g_folder": "application/vnd.google-apps.folder",
@@ -52,23 +98,97 @@ SUPPORTED_VIDEO_MIME_TYPES = [
     "video/ogg",
     "application/ogg",
 ]
-CONCURRENT_EXTRACTING_FOLDER = 10
-MAX_EXTRACTING_WORKER = 1
+# Drive list requests in flight per export, the crawler halves it when
+# Google answers with rate limit errors and grows it back on success
+MAX_EXTRACTING_WORKER = int(env.get("MAX_EXTRACTING_WORKER", 8))
+MAX_RATE_LIMIT_RETRY = 6
+RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+
+EXPORT_PAGES = metrics.registry.histogram(
+    "export_drive_pages",
+    "Drive API pages fetched per export",
+    buckets=(1, 5, 10, 50, 100, 500, 1000, 5000, 10000),
+)
+DRIVE_RATE_LIMITED = metrics.registry.counter(
+    "export_drive_rate_limited_total", "Drive API calls rate limited"
+)
+DUPLICATE_FOLDERS = metrics.registry.counter(
+    "export_drive_duplicate_folders_total",
+    "Folders reached again through another parent, not listed twice",
+)
+DUPLICATE_FILES = metrics.registry.counter(
+    "export_drive_duplicate_files_total",
+    "Files listed again under another parent, not exported twice",
+)
 
 logger = logging.getLogger(__name__)
-client = boto3.client(
-    "s3",
-    aws_access_key_id=AWS_ACCESS_KEY_ID,
-    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-    region_name=AWS_REGION,
-)
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+
+def get_s3_client():
+    """Builds the S3 client on first use, boto3 is slow to import"""
+    global _s3_client
+    if _s3_client is None:
+        with _s3_client_lock:
+            if _s3_client is None:
+                import boto3
+
+                _s3_client = boto3.client(
+                    "s3",
+                    aws_access_key_id=AWS_ACCESS_KEY_ID,
+                    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+                    region_name=AWS_REGION,
+                )
+    return _s3_client
 
 
 class WorkerException(Exception):
     pass
 
 
+class DriveRateLimitError(WorkerException):
+    pass
+
+
+class DriveApiError(WorkerException):
+    pass
+
+
 class DriveService:
+    _session = None
+    _session_lock = threading.Lock()
+
+    @classmethod
+    def session(cls):
+        """Keep-alive session shared by every crawler thread"""
+        if cls._session is None:
+            with cls._session_lock:
+                if cls._session is None:
+                    retry = Retry(
+                        total=DRIVE_API_RETRY,
+                        backoff_factor=1,
+                        status_forcelist=(500, 502, 503, 504),
+                        raise_on_status=False,
+                    )
+                    adapter = HTTPAdapter(
+                        pool_maxsize=MAX_EXTRACTING_WORKER, max_retries=retry
+                    )
+                    session = requests.Session()
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    session.hooks["response"].append(metrics.observe_http)
+                    session.headers.update(
+                        {
+                            "Accept": "application/json",
+                            "Accept-Encoding": "gzip",
+                            # Google only compresses for agents with gzip
+                            "User-Agent": "duongtang-worker (gzip)",
+                        }
+                    )
+                    cls._session = session
+        return cls._session
+
     @classmethod
     def is_valid_drive_id(cls, drive_id):
         return drive_id and drive_id.strip() != ""
@@ -82,35 +202,72 @@ class DriveService:
         return mime == DRIVE_FILE_MIME_TYPES["g_folder"]
 
     @classmethod
-    def get_files(cls, drive_id, api_key, next_page_token=None):
+    def is_rate_limited(cls, response):
+        if response.status_code == 429:
+            return True
+        if response.status_code != 403:
+            return False
+        try:
+            errors = response.json()["error"]["errors"]
+        except (ValueError, KeyError, TypeError):
+            return False
+        return any(
+            error.get("reason") in RATE_LIMIT_REASONS for error in errors
+        )
+
+    @classmethod
+    def build_query(cls, folder_ids):
         supported_mime_types = SUPPORTED_VIDEO_MIME_TYPES + [
             DRIVE_FILE_MIME_TYPES["g_folder"]
         ]
         mime_types_query = [
             'mimeType = "%s"' % mime for mime in supported_mime_types
         ]
-        q = '"%s" in parents and (%s)' % (
-            drive_id,
+        parents_query = [
+            '"%s" in parents' % folder_id for folder_id in folder_ids
+        ]
+        return "(%s) and (%s)" % (
+            " or ".join(parents_query),
             " or ".join(mime_types_query),
         )
+
+    @classmethod
+    def get_files(cls, drive_id, api_key, next_page_token=None):
+        return cls.get_files_batch([drive_id], api_key, next_page_token)
+
+    @classmethod
+    def get_files_batch(cls, folder_ids, api_key, next_page_token=None):
+        """
+        Lists the children of several folders with one query. The crawler
+        only needs the items themselves, not which folder they came from
+        """
+        q = cls.build_query(folder_ids)
         query = {
             "orderBy": "folder desc",  # trying to list all files on first
             "pageSize": PAGE_SIZE,
             "key": api_key,
             "q": q,
+            "fields": DRIVE_API_FIELDS,
         }
 
         if next_page_token is not None:
             query["pageToken"] = next_page_token
 
-        api_url = "https://www.googleapis.com/drive/v3/files?%s" % urlencode(
-            query
+        r = cls.session().get(
+            DRIVE_API_URL, params=query, timeout=DRIVE_API_TIMEOUT
         )
-        r = requests.get(api_url, headers={"Accept": "application/json"})
 
+        if cls.is_rate_limited(r):
+            raise DriveRateLimitError(
+                "rate limited with status {}".format(r.status_code)
+            )
         if r.status_code != 200:
-            logger.info("can not get files")
-            return [], [], None
+            # An empty result would silently truncate the export
+            raise DriveApiError(
+                "can not get files of {}, status {}".format(
+                    ",".join(folder_ids), r.status_code
+                )
+            )
 
         content = r.json()
         files = list(
@@ -129,21 +286,288 @@ class DriveService:
         return files, folders, next_page_token
 
 
+class DriveCrawler:
+    """
+    Breadth first crawl of a drive folder tree on a persistent pool.
+
+    Every (folder ids, page token) pair is a work item, subfolders and next
+    pages are queued as soon as their page is fetched so the pool never
+    waits for a whole level. Discovered folders are listed in batches
+    spread over the free slots, so wide trees of small folders cost far
+    fewer list calls. Concurrency is cut in half on rate limit errors and
+    grows by one after as many successful pages.
+
+    Folders reachable through several parents are listed once and files
+    with several parents are yielded once, duplicates are counted in
+    duplicate_folders and duplicate_files and in the matching metrics.
+
+    state() snapshots the frontier left after the pages yielded so far;
+    a crawler built with that state continues where the snapshot was taken.
+    """
+
+    def __init__(
+        self, api_key, max_workers=MAX_EXTRACTING_WORKER, state=None
+    ):
+        self.api_key = api_key
+        self.max_workers = max(1, max_workers)
+        self.concurrency = self.max_workers
+        self.pages = 0
+        self._successes = 0
+        # next pages and retries, their query can not change
+        self._pending = deque()
+        self._folders = deque()
+        self._futures = {}
+        self._restored = state is not None
+        self.duplicate_folders = 0
+        self.duplicate_files = 0
+        self.visited_folders = IdSet()
+        if EXPORT_DEDUP == "bloom":
+            self.emitted_files = BloomFilter(EXPORT_BLOOM_CAPACITY)
+        else:
+            self.emitted_files = IdSet()
+        if state is not None:
+            self.pages = state["pages"]
+            self.duplicate_folders = state["duplicate_folders"]
+            self.duplicate_files = state["duplicate_files"]
+            self.visited_folders = id_set_from_state(state["visited_folders"])
+            self.emitted_files = id_set_from_state(state["emitted_files"])
+            self._pending.extend(
+                (tuple(folder_ids), page_token, 0)
+                for folder_ids, page_token in state["pending"]
+            )
+            self._folders.extend(state["folders"])
+
+    def state(self):
+        # Pages in flight have not been yielded yet and are fetched again
+        items = list(self._pending) + list(self._futures.values())
+        return {
+            "pages": self.pages,
+            "pending": [
+                [list(folder_ids), page_token]
+                for folder_ids, page_token, _ in items
+            ],
+            "folders": list(self._folders),
+            "duplicate_folders": self.duplicate_folders,
+            "duplicate_files": self.duplicate_files,
+            "visited_folders": self.visited_folders.state(),
+            "emitted_files": self.emitted_files.state(),
+        }
+
+    def fetch(self, folder_ids, page_token, attempt):
+        if attempt > 0:
+            time.sleep(min(60, 2 ** attempt))
+        return DriveService.get_files_batch(
+            folder_ids, self.api_key, page_token
+        )
+
+    def next_batch(self, folders, free_slots):
+        size = min(MAX_FOLDER_BATCH, math.ceil(len(folders) / free_slots))
+        batch = [folders.popleft()]
+        while (
+            folders
+            and len(batch) < size
+            and len(DriveService.build_query(batch + [folders[0]]))
+            <= DRIVE_QUERY_MAX_LENGTH
+        ):
+            batch.append(folders.popleft())
+        return tuple(batch)
+
+    def on_rate_limited(self):
+        DRIVE_RATE_LIMITED.inc()
+        self.concurrency = max(1, self.concurrency // 2)
+        self._successes = 0
+        logger.warning(
+            "drive api rate limited, concurrency %s", self.concurrency
+        )
+
+    def on_success(self):
+        self.pages += 1
+        self._successes += 1
+        if (
+            self.concurrency < self.max_workers
+            and self._successes >= self.concurrency
+        ):
+            self.concurrency += 1
+            self._successes = 0
+
+    def crawl(self, drive_id):
+        """
+        Yields the new files of every fetched page, an empty list when it
+        only held folders or duplicates, so callers can checkpoint between
+        any two pages
+        """
+        pending = self._pending
+        folders = self._folders
+        futures = self._futures
+        if not self._restored:
+            self.visited_folders.add(drive_id)
+            folders.append(drive_id)
+        # Crawler threads report their requests under the calling handler
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            initializer=metrics.set_current_handler,
+            initargs=(metrics.current_handler(),),
+        ) as pool:
+            while pending or folders or futures:
+                while pending or folders:
+                    if len(futures) >= self.concurrency:
+                        break
+                    if pending:
+                        item = pending.popleft()
+                    else:
+                        free_slots = self.concurrency - len(futures)
+                        item = (self.next_batch(folders, free_slots), None, 0)
+                    futures[pool.submit(self.fetch, *item)] = item
+                done, _ = concurrent.futures.wait(
+                    futures, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    folder_ids, page_token, attempt = futures.pop(future)
+                    try:
+                        (files, subfolders, next_page_token) = future.result()
+                    except DriveRateLimitError:
+                        if attempt >= MAX_RATE_LIMIT_RETRY:
+                            raise
+                        self.on_rate_limited()
+                        pending.append((folder_ids, page_token, attempt + 1))
+                        continue
+                    self.on_success()
+                    if next_page_token:
+                        pending.append((folder_ids, next_page_token, 0))
+                    for folder in subfolders:
+                        if self.visited_folders.add(folder["id"]):
+                            folders.append(folder["id"])
+                        else:
+                            self.duplicate_folders += 1
+                            DUPLICATE_FOLDERS.inc()
+                    unique_files = [
+                        file for file in files
+                        if self.emitted_files.add(file["id"])
+                    ]
+                    duplicates = len(files) - len(unique_files)
+                    if duplicates:
+                        self.duplicate_files += duplicates
+                        DUPLICATE_FILES.inc(duplicates)
+                    yield unique_files
+
+
+class UploadPreparer:
+    """
+    Warms exported links up on a pool of threads while the crawl goes on.
+
+    The input queue is bounded so a slow api holds the crawl back instead
+    of buffering the whole export. Requests are capped by a token bucket
+    and every link is retried on its own, a failure never stops the rest.
+    """
+
+    def __init__(
+        self,
+        api_key,
+        max_workers=PREPARE_UPLOAD_WORKERS,
+        rate=PREPARE_UPLOAD_RATE,
+    ):
+        self.api_key = api_key
+        self.prepared = 0
+        self.failed = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._bucket = TokenBucket(rate)
+        self._queue = queue.Queue(maxsize=max_workers * 100)
+        self._session = requests.Session()
+        self._session.mount(
+            "http://", HTTPAdapter(pool_maxsize=max_workers)
+        )
+        self._session.mount(
+            "https://", HTTPAdapter(pool_maxsize=max_workers)
+        )
+        self._session.hooks["response"].append(metrics.observe_http)
+        self._threads = [
+            threading.Thread(
+                target=self._run,
+                args=(metrics.current_handler(),),
+                daemon=True,
+            )
+            for _ in range(max_workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, drive_urls):
+        for drive_url in drive_urls:
+            self._queue.put(drive_url)
+
+    def close(self, cancel=False):
+        if self._closed:
+            return
+        self._closed = True
+        if cancel:
+            try:
+                while True:
+                    self._queue.get_nowait()
+            except queue.Empty:
+                pass
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._session.close()
+        logger.info(
+            "prepared %s files, %s failed", self.prepared, self.failed
+        )
+
+    def _run(self, handler):
+        metrics.set_current_handler(handler)
+        while True:
+            drive_url = self._queue.get()
+            if drive_url is None:
+                return
+            prepared = self.prepare(drive_url)
+            with self._lock:
+                if prepared:
+                    self.prepared += 1
+                else:
+                    self.failed += 1
+
+    def _wait_for_token(self):
+        wait = self._bucket.try_consume()
+        while wait > 0:
+            time.sleep(wait)
+            wait = self._bucket.try_consume()
+
+    def prepare(self, drive_url):
+        for attempt in range(PREPARE_UPLOAD_RETRY):
+            if attempt > 0:
+                time.sleep(2 ** attempt)
+            self._wait_for_token()
+            try:
+                r = self._session.get(
+                    "{}/api/get".format(API_URL),
+                    params={"url": drive_url, "api_key": self.api_key},
+                    timeout=PREPARE_UPLOAD_TIMEOUT,
+                )
+            except requests.exceptions.RequestException as exc:
+                logger.warning(
+                    "prepare upload for %s failed: %s", drive_url, exc
+                )
+                continue
+            if r.status_code < 500 and r.status_code != 429:
+                return True
+            logger.warning(
+                "prepare upload for %s failed: %s", drive_url, r.status_code
+            )
+        logger.error("prepare upload for %s gave up", drive_url)
+        return False
+
+
 class DriveExtractorConsumer(PikaConsumer):
     QUEUE = "export_drive"
+    PAYLOAD = ExportPayload
     ROUTING_KEY = "default.export_drive"
     TMP_DIR = "./tmp"
 
     _session = None
     _upload_publisher = None
-
-    def __init__(self, url):
-        super().__init__(url)
-        if not path.exists(self.TMP_DIR):
-            try:
-                mkdir(self.TMP_DIR)
-            except Exception:
-                pass
+    _checkpoints = None
 
     def on_connection_closed(self, *args, **kwargs):
         super().on_connection_closed(*args, **kwargs)
@@ -152,70 +576,52 @@ class DriveExtractorConsumer(PikaConsumer):
 
     @property
     def db_session(self):
-        if self._session is None:
-            self._session = get_engine_session()
-        return self._session
+        return self.get_or_create("_session", get_engine_session)
 
-    def upload_to_s3(self, filename):
-        with open("{}/{}".format(self.TMP_DIR, filename), "rb") as f:
-            client.upload_fileobj(f, S3_BUCKET, filename)
-            logger.info("Upload file {} to s3 completed".format(filename))
+    @property
+    def checkpoints(self):
+        return self.get_or_create("_checkpoints", FileCheckpointStore)
+
+    def save_checkpoint(self, filename, crawler, sink, total_file):
+        self.checkpoints.save(
+            filename,
+            {
+                "crawler": crawler.state(),
+                "sink": sink.state(),
+                "total_file": total_file,
+            },
+        )
 
-    def remove_tmp_file(self, filename):
-        filepath = "{}/{}".format(self.TMP_DIR, filename)
-        if path.exists(filepath):
-            remove(filepath)
-            logger.info("Delete tmp file {} completed".format(filename))
+    def create_sink(self, filename):
+        if EXPORT_STORAGE == "local":
+            return LocalSink(self.TMP_DIR, filename, compress=EXPORT_GZIP)
+        return S3MultipartSink(
+            get_s3_client(), S3_BUCKET, filename, compress=EXPORT_GZIP
+        )
 
     def get_drive_url(self, drive_id):
         return "https://drive.google.com/open?id={}".format(drive_id)
 
-    def extract_drive(self, drive_id):
-        logger.info("extracting drive {}".format(drive_id))
-        folder_ids = [{"drive_id": drive_id, "next_page_token": None}]
-        api_key = Config.get_one_by_key(self.db_session, GDRIVE_API_KEY)
-        while len(folder_ids) > 0:
-            with concurrent.futures.ThreadPoolExecutor(
-                max_workers=MAX_EXTRACTING_WORKER
-            ) as worker:
-                futures = {
-                    worker.submit(
-                        DriveService.get_files,
-                        item["drive_id"],
-                        api_key["value"],
-                        item["next_page_token"],
-                    ): item
-                    for item in folder_ids[:CONCURRENT_EXTRACTING_FOLDER]
-                }
-                for future in concurrent.futures.as_completed(futures):
-                    item = futures[future]
-                    (files, folders, page_token) = future.result()
-                    if len(files) > 0:
-                        yield [self.get_drive_url(file["id"]) for file in files]
-                    if page_token:
-                        item["next_page_token"] = page_token
-                    else:
-                        folder_ids.remove(item)
-
-                    for folder in folders:
-                        folder_ids.append(
-                            {"drive_id": folder["id"], "next_page_token": None}
-                        )
-        logger.info("extracting completed")
-
-    def prepare_upload(self, filename, api_key):
-        try:
-            with open("{}/{}".format(self.TMP_DIR, filename)) as f:
-                reader = csv.reader(f)
-                for row in reader:
-                    drive_id = row[0]
-                    url = "{}/api/get?url={}&api_key={}".format(
-                        API_URL, drive_id, api_key
-                    )
-                    logger.info("prepare upload for {}".format(drive_id))
-                    requests.get(url)
-        except requests.exceptions.RequestException as exc:
-            logger.error("prepare upload with errors: {}".format(exc))
+    def create_crawler(self, state=None):
+        api_key = credentials.get(self.db_session, GDRIVE_API_KEY)
+        if api_key is None:
+            raise WorkerException("no api key is available")
+        return DriveCrawler(api_key["value"], state=state)
+
+    def extract_drive(self, drive_id, crawler=None):
+        logger.info("extracting drive %s", drive_id)
+        if crawler is None:
+            crawler = self.create_crawler()
+        for files in crawler.crawl(drive_id):
+            yield [self.get_drive_url(file["id"]) for file in files]
+        EXPORT_PAGES.observe(crawler.pages)
+        logger.info(
+            "extracting completed, %s pages, skipped %s duplicate folders "
+            "and %s duplicate files",
+            crawler.pages,
+            crawler.duplicate_folders,
+            crawler.duplicate_files,
+        )
 
     def get_user_drive(self, req_id):
         return self.db_session.query(UserDrive).filter_by(id=req_id).first()
@@ -226,79 +632,136 @@ class DriveExtractorConsumer(PikaConsumer):
             self.db_session.commit()
         except SQLAlchemyError as exc:
             self.db_session.rollback()
-            print(exc)
-            logger.error("update db with errors: {}".format(exc))
+            logger.error("update db with errors: %s", exc)
 
-    def add_balance_log(self, data):
+    def finish_export(self, req_id, balance_log=None, **data):
+        """Writes the export result and its balance log in one transaction"""
         try:
-            self.db_session.add(BalanceLog(**data))
+            self.db_session.query(UserDrive).filter_by(id=req_id).update(data)
+            if balance_log is not None:
+                self.db_session.add(BalanceLog(**balance_log))
             self.db_session.commit()
         except SQLAlchemyError as exc:
             self.db_session.rollback()
-            logger.error("add balance error {}".format(exc))
+            raise WorkerException("finish export with errors: {}".format(exc))
+
+    def invalid_request_id(self, properties, body):
+        """id of the export an invalid message was sent for, if any"""
+        try:
+            data = codec.decode(body, properties.content_type)
+        except InvalidMessageError:
+            return None
+        if not isinstance(data, dict):
+            return None
+        req_id = data.get("id")
+        if isinstance(req_id, (int, str)) and not isinstance(req_id, bool):
+            return req_id
+        return None
 
     def on_message(self, _unused_channel, basic_deliver, properties, body):
-        body = json.loads(body)
-        drive_id = body["drive_id"]
-        req_id = body["id"]
-        api_key = body["api_key"]
-        upload_flag = False
+        try:
+            message = self.decode_message(properties, body)
+        except InvalidMessageError as exc:
+            logger.error("invalid export message: %s", exc)
+            # The export can never run, do not leave it pending
+            req_id = self.invalid_request_id(properties, body)
+            if req_id is not None:
+                self.update_db(req_id, status=UserDrive.ERROR_STATUS)
+            self.acknowledge_message(basic_deliver.delivery_tag)
+            return
+        drive_id = message.drive_id
+        req_id = message.id
+        api_key = message.api_key
+        upload_flag = PREPARE_UPLOAD
+        preparer = None
+        sink = None
         logger.info(
-            "received a message req_id={}\
-            drive_id={}".format(
-                req_id, drive_id
-            )
+            "received a message req_id=%s drive_id=%s", req_id, drive_id
         )
         try:
-            if drive_id is None:
-                raise WorkerException("drive id is missing")
-            if req_id is None:
-                raise WorkerException("req_id is missing")
-
             user_drive = self.get_user_drive(req_id)
             if user_drive is None:
                 raise WorkerException("user_drive not found")
 
             filename = "{}_{}.csv".format(drive_id, req_id)
             total_file = 0
-            self.update_db(req_id, status=UserDrive.EXTRACTING_STATUS)
-            with open("{}/{}".format(self.TMP_DIR, filename), mode="w+") as f:
-                for drives in self.extract_drive(drive_id):
-                    total_file += len(drives)
-                    f.write("\n".join(drives) + "\n")
-            self.update_db(
-                req_id, status=UserDrive.FINISHED_STATUS, total_file=total_file
-            )
-            logger.info("total drive id found: {}".format(total_file))
-            if total_file > 0:
-                self.upload_to_s3(filename)
-                if upload_flag:
-                    self.prepare_upload(filename, api_key)
+            checkpoint = self.checkpoints.load(filename)
+            sink = self.create_sink(filename)
+            # The upload is aborted if anything below fails, restored or not
+            with sink:
+                if checkpoint is not None:
+                    logger.info("resuming export %s", filename)
+                    sink.restore(checkpoint["sink"])
+                    total_file = checkpoint["total_file"]
                 else:
-                    self.add_balance_log(
-                        {
-                            "user_id": user_drive.user_id,
-                            "balance": (total_file * -1),
-                            "transaction_timestamp": get_unix_time(),
-                            "transaction_type": "EXPORT_DRIVE",
-                            "source_id": req_id,
-                        }
-                    )
-                self.remove_tmp_file(filename)
+                    # Left by a run whose checkpoint was lost
+                    sink.abort_incomplete()
+                crawler = self.create_crawler(
+                    checkpoint["crawler"] if checkpoint else None
+                )
+                self.update_db(req_id, status=UserDrive.EXTRACTING_STATUS)
+                if upload_flag:
+                    preparer = UploadPreparer(api_key)
+                checkpointed_at = progressed_at = time.monotonic()
+                # Parts are uploaded while the drive is still being crawled
+                for drives in self.extract_drive(drive_id, crawler):
+                    if drives:
+                        total_file += len(drives)
+                        sink.write(drives)
+                        if preparer is not None:
+                            preparer.submit(drives)
+                    now = time.monotonic()
+                    if now - progressed_at >= EXPORT_PROGRESS_INTERVAL:
+                        progress = {"total_file": total_file}
+                        if preparer is not None:
+                            progress["prepared_file"] = preparer.prepared
+                        self.update_db(req_id, **progress)
+                        progressed_at = now
+                    if now - checkpointed_at >= EXPORT_CHECKPOINT_INTERVAL:
+                        self.save_checkpoint(
+                            filename, crawler, sink, total_file
+                        )
+                        checkpointed_at = now
+            self.checkpoints.delete(filename)
+            logger.info("total drive id found: %s", total_file)
+            # Status, total and charge are only written once the file is
+            # uploaded, and together
+            result = {
+                "status": UserDrive.FINISHED_STATUS,
+                "total_file": total_file,
+            }
+            balance_log = None
+            if preparer is not None:
+                preparer.close()
+                result["prepared_file"] = preparer.prepared
+            elif total_file > 0:
+                balance_log = {
+                    "user_id": user_drive.user_id,
+                    "balance": (total_file * -1),
+                    "transaction_timestamp": get_unix_time(),
+                    "transaction_type": "EXPORT_DRIVE",
+                    "source_id": req_id,
+                }
+            self.finish_export(req_id, balance_log=balance_log, **result)
         except (Exception, WorkerException) as exc:
-            logger.error("export has error: {}".format(exc))
+            logger.error("export has error: %s", exc)
+            if sink is not None:
+                # The upload was aborted, a retry has to start over
+                self.checkpoints.delete(
+                    "{}_{}.csv".format(drive_id, req_id)
+                )
             self.update_db(req_id, status=UserDrive.ERROR_STATUS)
         finally:
+            if preparer is not None:
+                preparer.close(cancel=True)
             self.acknowledge_message(basic_deliver.delivery_tag)
 
 
 def main():
-    logging.basicConfig(
-        level=env.get("LOG_LEVEL", logging.INFO), format=LOG_FORMAT
-    )
+    setup_logging(fmt=LOG_FORMAT)
     logging.getLogger("pika").setLevel(logging.WARNING)
     consumer = DriveExtractorConsumer(AMQP_BROKER_URL)
-    consumer.run()
+    run_consumer(consumer)
 
 
 if __name__ == "__main__":
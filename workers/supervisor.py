@@ -0,0 +1,144 @@
+import importlib
+import logging
+import multiprocessing
+import os
+import signal
+import time
+from os import environ as env
+from core.logs import setup_logging
+
+LOGGER = logging.getLogger(__name__)
+
+# Worker types and process counts, e.g. "cookie:2,register,recheck:1"
+SUPERVISED_WORKERS = env.get('WORKERS', '')
+# Pin every child to one CPU, round-robin over the CPUs available
+WORKER_CPU_AFFINITY = env.get('WORKER_CPU_AFFINITY', '0') == '1'
+# Seconds children get to drain after SIGTERM before they are killed
+WORKER_SHUTDOWN_TIMEOUT = int(env.get('WORKER_SHUTDOWN_TIMEOUT', 60))
+# A child dying sooner than this after its start is restarted with backoff
+WORKER_MIN_UPTIME = 10
+WORKER_MAX_BACKOFF = 60
+# Children serve their metrics on METRICS_PORT, METRICS_PORT + 1, ...
+METRICS_PORT = int(env.get('METRICS_PORT', 0))
+
+
+def parse_workers(spec):
+    workers = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        name, _, count = item.partition(':')
+        workers.append((name.strip(), int(count or 1)))
+    return workers
+
+
+def run_worker(name, cpu, metrics_port=0):
+    # The parent's handlers were inherited, the worker installs its own
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    if cpu is not None:
+        os.sched_setaffinity(0, {cpu})
+    env['METRICS_PORT'] = str(metrics_port)
+    importlib.import_module('workers.{}'.format(name)).main()
+
+
+class Child(object):
+    def __init__(self, name, index, cpu=None, metrics_port=0):
+        self.name = name
+        self.index = index
+        self.cpu = cpu
+        self.metrics_port = metrics_port
+        self.process = None
+        self.started_at = 0
+        self.restart_at = 0
+        self.backoff = 1
+
+    def __str__(self):
+        return '{}#{}'.format(self.name, self.index)
+
+    def start(self):
+        self.process = multiprocessing.Process(
+            target=run_worker, args=(self.name, self.cpu, self.metrics_port),
+            name=str(self))
+        self.process.start()
+        self.started_at = time.monotonic()
+        LOGGER.info('Started %s (pid %s)', self, self.process.pid)
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+
+class Supervisor(object):
+    """
+    Forks the configured number of processes per worker type, restarts the
+    ones that die and forwards SIGTERM / SIGINT to all of them on shutdown
+    """
+
+    def __init__(self, workers, cpu_affinity=WORKER_CPU_AFFINITY):
+        cpus = sorted(os.sched_getaffinity(0)) if cpu_affinity else None
+        self.children = []
+        for name, count in workers:
+            for index in range(count):
+                slot = len(self.children)
+                cpu = cpus[slot % len(cpus)] if cpus else None
+                port = METRICS_PORT + slot if METRICS_PORT else 0
+                self.children.append(Child(name, index, cpu, port))
+        self._stopping = False
+
+    def _on_signal(self, signum, _frame):
+        LOGGER.info('Received signal %d, stopping workers', signum)
+        self._stopping = True
+
+    def check(self, child):
+        if child.is_alive():
+            return
+        now = time.monotonic()
+        if child.process is not None and child.restart_at == 0:
+            LOGGER.warning('%s exited with code %s', child,
+                           child.process.exitcode)
+            if now - child.started_at < WORKER_MIN_UPTIME:
+                child.backoff = min(WORKER_MAX_BACKOFF, child.backoff * 2)
+            else:
+                child.backoff = 1
+            child.restart_at = now + child.backoff
+        if now >= child.restart_at:
+            child.restart_at = 0
+            child.start()
+
+    def shutdown(self):
+        for child in self.children:
+            if child.is_alive():
+                os.kill(child.process.pid, signal.SIGTERM)
+        deadline = time.monotonic() + WORKER_SHUTDOWN_TIMEOUT
+        for child in self.children:
+            if child.process is None:
+                continue
+            child.process.join(max(0, deadline - time.monotonic()))
+            if child.is_alive():
+                LOGGER.warning('%s did not drain in time, killing it', child)
+                child.process.kill()
+                child.process.join()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+        while not self._stopping:
+            for child in self.children:
+                self.check(child)
+            time.sleep(1)
+        self.shutdown()
+        LOGGER.info('All workers stopped')
+
+
+def main():
+    setup_logging()
+    workers = parse_workers(SUPERVISED_WORKERS)
+    if not workers:
+        LOGGER.error('No worker configured, set WORKERS="cookie:2,recheck"')
+        return
+    Supervisor(workers).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,6 @@
+from core.pika import PikaPublisher
+
+
+class UploadPublisher(PikaPublisher):
+    ROUTING_KEY = 'default.upload'
+    CONFIRM_DELIVERY = True